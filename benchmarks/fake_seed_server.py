@@ -0,0 +1,306 @@
+#!/usr/bin/env python3
+"""
+A local stand-in for the Stage Based Messaging service and Identity Store,
+implementing only the endpoints the scripts use, with configurable latency
+and error injection, for benchmarking the scripts without production.
+"""
+
+import argparse
+import json
+import random
+import sys
+import threading
+import time
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, urlencode, urlsplit
+
+parser = argparse.ArgumentParser(description='Run a fake Stage Based '
+                                 'Messaging service and Identity Store.')
+parser.add_argument('--port', type=int, default=8000,
+                    help='The port to listen on.')
+parser.add_argument('--page-size', type=int, default=1000,
+                    help='The number of results in each page of a list.')
+parser.add_argument('--latency', type=float, default=0.0,
+                    help='The number of seconds to delay each response by.')
+parser.add_argument('--jitter', type=float, default=0.0,
+                    help='The most number of seconds to randomly add to the '
+                    '--latency of each response.')
+parser.add_argument('--error-rate', type=float, default=0.0,
+                    help='The fraction of requests to respond to with '
+                    '--error-code.')
+parser.add_argument('--error-code', type=int, default=503,
+                    help='The status code of injected errors.')
+parser.add_argument('--messagesets', type=int, default=60,
+                    help='The number of messagesets to start with.')
+parser.add_argument('--lapsed', type=int, default=0,
+                    help='The number of completed subscriptions to '
+                    '--old-messageset to start with.')
+parser.add_argument('--old-messageset', type=int, default=9,
+                    help='The messageset of the --lapsed subscriptions.')
+parser.add_argument(
+    '--no-bulk', default=False, action='store_const', const=True,
+    help='Reject lists of subscriptions to create, like a service without '
+    'bulk creation.')
+parser.add_argument('--optout-percent', type=int, default=5,
+                    help='The percentage of identities that have opted out.')
+
+
+class Subscriptions(object):
+    """
+    The subscriptions, indexed by messageset and by identity so that the
+    filters the scripts use don't scan every subscription.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.subscriptions = []
+        self.by_messageset = {}
+        self.by_identity = {}
+        # Filtered lists, reused while paging through them until the
+        # messageset they're from changes
+        self.versions = {}
+        self.filtered = {}
+
+    def add(self, data):
+        with self.lock:
+            subscription = dict(data)
+            subscription['id'] = len(self.subscriptions) + 1
+            subscription.setdefault('active', True)
+            subscription.setdefault('completed', False)
+            self.subscriptions.append(subscription)
+            messageset = subscription.get('messageset')
+            self.by_messageset.setdefault(messageset, []).append(
+                subscription)
+            self.by_identity.setdefault(
+                subscription.get('identity'), []).append(subscription)
+            self.versions[messageset] = self.versions.get(messageset, 0) + 1
+            return subscription
+
+    def filter(self, params):
+        with self.lock:
+            if 'identity' in params:
+                candidates = self.by_identity.get(params['identity'], [])
+            elif 'messageset' in params:
+                candidates = self.by_messageset.get(
+                    int(params['messageset']), [])
+            else:
+                candidates = self.subscriptions
+            if len(candidates) < 100:
+                return [s for s in candidates if matches(s, params)]
+
+            key = tuple(sorted(params.items()))
+            if 'messageset' in params:
+                version = self.versions.get(int(params['messageset']), 0)
+            else:
+                version = len(self.subscriptions)
+            cached = self.filtered.get(key)
+            if cached is None or cached[0] != version:
+                cached = (version,
+                          [s for s in candidates if matches(s, params)])
+                self.filtered[key] = cached
+            return cached[1]
+
+
+def matches(subscription, params):
+    for key, value in params.items():
+        actual = subscription.get(key)
+        if isinstance(actual, bool):
+            if actual != (value.lower() == 'true'):
+                return False
+        elif str(actual) != value:
+            return False
+    return True
+
+
+def validate_subscription(data):
+    """
+    Returns the errors for each invalid field of a subscription to create,
+    like the service's serializer does.
+    """
+    if not isinstance(data, dict):
+        return {'non_field_errors': ['Invalid data.']}
+    return dict((field, ['This field is required.'])
+                for field in ('identity', 'messageset', 'schedule')
+                if data.get(field) is None)
+
+
+def make_messageset(messageset_id):
+    return {
+        'id': messageset_id,
+        'short_name': 'messageset.%s' % messageset_id,
+        'content_type': 'audio',
+        'notes': '',
+        'next_set': None,
+        'default_schedule': messageset_id,
+    }
+
+
+class FakeSeedServices(object):
+
+    def __init__(self, args):
+        self.args = args
+        self.subscriptions = Subscriptions()
+        self.messagesets = dict(
+            (i, make_messageset(i)) for i in range(1, args.messagesets + 1))
+        self.messagesets_lock = threading.Lock()
+        self.calls = {}
+        self.calls_lock = threading.Lock()
+        for i in range(args.lapsed):
+            self.subscriptions.add({
+                'identity': 'lapsed-%08d' % i,
+                'messageset': args.old_messageset,
+                'active': False,
+                'completed': True,
+            })
+
+    def count(self, method, path):
+        endpoint = '%s %s' % (method, path.strip('/').split('/')[0])
+        with self.calls_lock:
+            self.calls[endpoint] = self.calls.get(endpoint, 0) + 1
+
+    def page(self, base_url, path, params, results):
+        limit = int(params.pop('limit', self.args.page_size))
+        offset = int(params.pop('offset', 0))
+        next_url = None
+        if offset + limit < len(results):
+            next_url = '%s%s?%s' % (base_url, path, urlencode(
+                dict(params, limit=limit, offset=offset + limit)))
+        return 200, {
+            'count': len(results),
+            'next': next_url,
+            'previous': None,
+            'results': results[offset:offset + limit],
+        }
+
+    def get(self, base_url, path, params):
+        parts = path.strip('/').split('/')
+        if path == '/subscriptions/':
+            filters = dict((k, v) for k, v in params.items()
+                           if k not in ('limit', 'offset'))
+            return self.page(base_url, path, params,
+                             self.subscriptions.filter(filters))
+        if path == '/messageset/':
+            with self.messagesets_lock:
+                messagesets = [
+                    m for _, m in sorted(self.messagesets.items())
+                    if all(str(m.get(k)) == v for k, v in params.items()
+                           if k not in ('limit', 'offset'))]
+            return self.page(base_url, path, params, messagesets)
+        if parts[0] == 'messageset' and len(parts) == 2:
+            return 200, make_messageset(int(parts[1]))
+        if parts[0] == 'messageset' and parts[2:] == ['messages']:
+            return 200, {'messages': [{
+                'id': i,
+                'sequence_number': i,
+                'lang': 'eng_ZA',
+                'text_content': 'Message %s' % i,
+                'binary_content': {
+                    'content': '%s/audio/%s/%s.mp3' % (
+                        base_url, parts[1], i)},
+            } for i in range(1, 11)]}
+        if parts[0] == 'identities' and len(parts) == 2:
+            opted_out = (zlib.crc32(parts[1].encode('utf-8')) % 100 <
+                         self.args.optout_percent)
+            return 200, {
+                'id': parts[1],
+                'details': {'addresses': {'msisdn': {
+                    '+27%09d' % (zlib.crc32(parts[1].encode('utf-8')) %
+                                 10 ** 9): {'optedout': opted_out}}}},
+            }
+        if path == '/_calls':
+            with self.calls_lock:
+                return 200, dict(self.calls)
+        return 404, {'detail': 'Not found.'}
+
+    def post(self, path, data):
+        if path == '/subscriptions/':
+            if isinstance(data, list) and not self.args.no_bulk:
+                errors = [validate_subscription(item) for item in data]
+                if any(errors):
+                    return 400, errors
+                return 201, [self.subscriptions.add(item) for item in data]
+            if not isinstance(data, dict):
+                return 400, {'non_field_errors': [
+                    'Invalid data. Expected a dictionary, but got list.']}
+            errors = validate_subscription(data)
+            if errors:
+                return 400, errors
+            return 201, self.subscriptions.add(data)
+        if path == '/messageset/':
+            with self.messagesets_lock:
+                messageset = dict(data, id=max(self.messagesets) + 1)
+                self.messagesets[messageset['id']] = messageset
+            return 201, messageset
+        return 404, {'detail': 'Not found.'}
+
+
+def make_handler(services):
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+        # The headers and body are written separately
+        disable_nagle_algorithm = True
+
+        def log_message(self, format, *args):
+            pass
+
+        def respond(self, status, body, content_type='application/json'):
+            if not isinstance(body, bytes):
+                body = json.dumps(body).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def inject(self, path):
+            """
+            Delays the response, and returns True if an error was sent
+            instead of it.
+            """
+            if path.startswith('/_'):
+                return False
+            services.count(self.command, path)
+            delay = services.args.latency
+            if services.args.jitter:
+                delay += random.uniform(0, services.args.jitter)
+            if delay:
+                time.sleep(delay)
+            if random.random() < services.args.error_rate:
+                self.respond(services.args.error_code,
+                             {'detail': 'Injected error.'})
+                return True
+            return False
+
+        def do_GET(self):
+            url = urlsplit(self.path)
+            if self.inject(url.path):
+                return
+            if url.path.startswith('/audio/'):
+                return self.respond(200, b'\0' * 16 * 1024, 'audio/mpeg')
+            base_url = 'http://%s' % self.headers.get('Host')
+            status, body = services.get(base_url, url.path,
+                                        dict(parse_qsl(url.query)))
+            self.respond(status, body)
+
+        def do_POST(self):
+            length = int(self.headers.get('Content-Length', 0))
+            data = json.loads(self.rfile.read(length) or b'null')
+            url = urlsplit(self.path)
+            if self.inject(url.path):
+                return
+            status, body = services.post(url.path, data)
+            self.respond(status, body)
+
+    return Handler
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    server = ThreadingHTTPServer(('127.0.0.1', args.port),
+                                 make_handler(FakeSeedServices(args)))
+    server.daemon_threads = True
+    sys.stdout.write("Listening on http://127.0.0.1:%s/\n" % args.port)
+    sys.stdout.flush()
+    server.serve_forever()
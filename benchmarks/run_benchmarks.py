@@ -0,0 +1,212 @@
+#!/usr/bin/env python3
+"""
+Runs the scripts against the fake seed services with synthetic inputs,
+reporting the rows processed per second and peak memory use of each run.
+"""
+
+import argparse
+import json
+import os
+import random
+import shlex
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from collections import OrderedDict
+from urllib.request import urlopen
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCHMARKS_DIR)
+
+parser = argparse.ArgumentParser(description='Benchmark the scripts against '
+                                 'a local fake of the seed services.')
+parser.add_argument('--scripts', nargs='+',
+                    choices=['service_disruption', 'immunisation', 'pmtct',
+                             'nurseconnect'],
+                    help='The scripts to benchmark. All of them by default.')
+parser.add_argument('--sizes', nargs='+', type=int, default=[10000],
+                    help='The numbers of identities to benchmark with.')
+parser.add_argument('--concurrency', type=int, default=8,
+                    help='The --concurrency to run the scripts with.')
+parser.add_argument('--script-args', default='',
+                    help='Extra arguments to pass to every script.')
+parser.add_argument('--server-args', default='',
+                    help='Extra arguments to pass to the fake seed services.')
+parser.add_argument('--latency', type=float, default=0.0,
+                    help='The number of seconds the fake services delay each '
+                    'response by.')
+parser.add_argument('--jitter', type=float, default=0.0,
+                    help='The most number of seconds the fake services '
+                    'randomly add to the --latency.')
+parser.add_argument('--error-rate', type=float, default=0.0,
+                    help='The fraction of requests the fake services respond '
+                    'to with an error.')
+parser.add_argument('--seed', type=int, default=0,
+                    help='The seed for generating the synthetic inputs.')
+parser.add_argument('--work-dir',
+                    help='The directory to write the inputs and outputs to. '
+                    'A temporary directory by default.')
+parser.add_argument('--json', dest='json_file',
+                    help='Name of file to write the results to as JSON.')
+
+
+def service_disruption_row(rng, i):
+    return {'identity': 'identity-%08d' % i, 'language': 'eng_ZA'}
+
+
+def immunisation_row(rng, i):
+    current_messageset = rng.choice([7, 8, 42, 43, 11])
+    expected_messageset = rng.choice([7, 8, 42, 43])
+    current_sequence = rng.randint(1, 40)
+    return {
+        'identity': 'identity-%08d' % i,
+        'language': 'eng_ZA',
+        'current_messageset_id': current_messageset,
+        'current_sequence_number': current_sequence,
+        'expected_messageset_id': expected_messageset,
+        'expected_sequence_number': rng.randint(current_sequence, 45),
+    }
+
+
+def pmtct_row(rng, i):
+    current_messageset = rng.choice([3, 4, 5, 1, 46, 47, 48, 49])
+    current_sequence = rng.randint(1, 30)
+    return {
+        'identity': 'identity-%08d' % i,
+        'language': 'eng_ZA',
+        'current_messageset_id': current_messageset,
+        'current_sequence_number': current_sequence,
+        'expected_messageset_id': rng.choice(
+            [current_messageset, 1, 2]),
+        'expected_sequence_number': rng.randint(current_sequence, 40),
+    }
+
+
+# The script, the function generating its input rows, if any, and its
+# arguments, for each benchmark
+SCRIPTS = OrderedDict([
+    ('service_disruption', (
+        'service_disruption_subs.py', service_disruption_row,
+        ['--messageset-id', '1', '--execute'])),
+    ('immunisation', (
+        'immunisation_subs.py', immunisation_row,
+        ['--messageset-ids', '1', '2', '3', '4', '--execute'])),
+    ('pmtct', (
+        'pmtct_missed_sets.py', pmtct_row, ['--execute'])),
+    ('nurseconnect', (
+        'nurseconnect_resubscribe.py', None,
+        ['--new-messageset', '10', '--old-messageset', '9'])),
+])
+
+
+def write_input(path, make_row, size, seed):
+    rng = random.Random(seed)
+    with open(path, 'w') as f:
+        for i in range(size):
+            f.write(json.dumps(make_row(rng, i)) + '\n')
+
+
+def free_port():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def start_server(args, lapsed=0):
+    """
+    Starts the fake seed services, returning the process and their url.
+    """
+    port = free_port()
+    server = subprocess.Popen([
+        sys.executable, os.path.join(BENCHMARKS_DIR, 'fake_seed_server.py'),
+        '--port', str(port), '--lapsed', str(lapsed),
+        '--latency', str(args.latency), '--jitter', str(args.jitter),
+        '--error-rate', str(args.error_rate),
+    ] + shlex.split(args.server_args), stdout=subprocess.DEVNULL)
+    url = 'http://127.0.0.1:%s/' % port
+    for _ in range(100):
+        try:
+            urlopen(url + '_calls').read()
+            return server, url
+        except IOError:
+            time.sleep(0.1)
+    server.kill()
+    sys.exit("The fake seed services didn't start")
+
+
+def run_script(argv, stdout, stderr):
+    """
+    Runs the script, returning its exit code, the seconds it took, and its
+    peak resident set size in megabytes.
+    """
+    started = time.time()
+    process = subprocess.Popen(argv, cwd=REPO_DIR, stdout=stdout,
+                               stderr=stderr)
+    _, status, usage = os.wait4(process.pid, 0)
+    process.returncode = os.waitstatus_to_exitcode(status)
+    return (process.returncode, time.time() - started,
+            usage.ru_maxrss / 1024.0)
+
+
+def benchmark(args, name, size, work_dir):
+    script, make_row, script_args = SCRIPTS[name]
+    server, url = start_server(args, lapsed=0 if make_row else size)
+    try:
+        argv = [sys.executable, script, '--sbm-url', url, '--sbm-token',
+                'token', '--concurrency', str(args.concurrency)]
+        if make_row is None:
+            argv += ['--is-url', url, '--is-token', 'token']
+        else:
+            input_path = os.path.join(work_dir, '%s-%s.jsonl' % (name, size))
+            if not os.path.exists(input_path):
+                write_input(input_path, make_row, size, args.seed)
+            argv += ['--file', input_path]
+        argv += script_args + shlex.split(args.script_args)
+
+        output = os.path.join(work_dir, '%s-%s' % (name, size))
+        with open(output + '.out', 'w') as stdout, \
+                open(output + '.err', 'w') as stderr:
+            code, seconds, peak_rss = run_script(argv, stdout, stderr)
+        calls = json.loads(urlopen(url + '_calls').read().decode('utf-8'))
+    finally:
+        server.kill()
+        server.wait()
+    return OrderedDict([
+        ('script', name),
+        ('rows', size),
+        ('exit_code', code),
+        ('seconds', seconds),
+        ('rows_per_second', size / seconds),
+        ('peak_rss_mb', peak_rss),
+        ('requests', sum(calls.values())),
+    ])
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix='seed-benchmarks-')
+    if not os.path.isdir(work_dir):
+        os.makedirs(work_dir)
+
+    results = []
+    sys.stdout.write("%-20s %9s %9s %11s %12s %10s %5s\n" % (
+        'script', 'rows', 'seconds', 'rows/sec', 'peak RSS MB', 'requests',
+        'exit'))
+    for size in args.sizes:
+        for name in args.scripts or SCRIPTS:
+            result = benchmark(args, name, size, work_dir)
+            results.append(result)
+            sys.stdout.write("%-20s %9d %9.1f %11.1f %12.1f %10d %5d\n" % (
+                name, size, result['seconds'], result['rows_per_second'],
+                result['peak_rss_mb'], result['requests'],
+                result['exit_code']))
+            sys.stdout.flush()
+    sys.stdout.write("Inputs and outputs are in %s\n" % work_dir)
+
+    if args.json_file:
+        with open(args.json_file, 'w') as f:
+            json.dump(results, f, indent=2)
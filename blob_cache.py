@@ -0,0 +1,139 @@
+"""
+A persistent cache of downloaded files, so that repeated runs don't fetch
+or store the same content twice.
+"""
+
+import hashlib
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+
+# The umask, read once at import since reading it means setting it. Files
+# from mkstemp are only readable by their owner, so stored files are given
+# the permissions the umask would give any other new file instead.
+UMASK = os.umask(0)
+os.umask(UMASK)
+
+
+class BlobCache(object):
+    """
+    Stores downloaded files in `directory`, named by the SHA-256 of their
+    content, and indexed by the URL they were downloaded from in a SQLite
+    database in the same directory.
+
+    Once the stored files add up to more than `max_size` bytes, the least
+    recently used ones are removed. Files used since the cache was opened
+    are never removed, so that anything referenced by the current run stays
+    on disk. Using the cache from several threads at once is safe.
+    """
+
+    def __init__(self, directory, max_size=None):
+        self.directory = directory
+        self.max_size = max_size
+        self.opened_at = time.time()
+        self.lock = threading.Lock()
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.db = sqlite3.connect(os.path.join(directory, 'index.sqlite3'),
+                                  check_same_thread=False)
+        with self.lock, self.db:
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS urls ("
+                "url TEXT PRIMARY KEY, filename TEXT)")
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS blobs ("
+                "filename TEXT PRIMARY KEY, size INTEGER, last_used REAL)")
+
+    def path(self, filename):
+        return os.path.join(self.directory, filename)
+
+    def get(self, url):
+        """
+        Returns the name of the file downloaded from `url`, or None if it
+        isn't in the cache.
+        """
+        with self.lock, self.db:
+            row = self.db.execute(
+                "SELECT filename FROM urls WHERE url = ?", (url,)).fetchone()
+            if row is None:
+                return None
+            filename = row[0]
+            if not os.path.exists(self.path(filename)):
+                self.db.execute("DELETE FROM urls WHERE filename = ?",
+                                (filename,))
+                self.db.execute("DELETE FROM blobs WHERE filename = ?",
+                                (filename,))
+                return None
+            self.db.execute(
+                "UPDATE blobs SET last_used = ? WHERE filename = ?",
+                (time.time(), filename))
+        return filename
+
+    def put(self, url, chunks, suffix=''):
+        """
+        Stores the content in `chunks`, downloaded from `url`, and returns
+        the name of its file. Content that is already stored isn't written
+        again.
+        """
+        digest = hashlib.sha256()
+        size = 0
+        fd, part_path = tempfile.mkstemp(suffix='.part', dir=self.directory)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                for chunk in chunks:
+                    digest.update(chunk)
+                    size += len(chunk)
+                    f.write(chunk)
+            os.chmod(part_path, 0o666 & ~UMASK)
+        except BaseException:
+            os.remove(part_path)
+            raise
+
+        filename = digest.hexdigest() + suffix
+        with self.lock, self.db:
+            if os.path.exists(self.path(filename)):
+                os.remove(part_path)
+            else:
+                os.rename(part_path, self.path(filename))
+            self.db.execute(
+                "INSERT OR REPLACE INTO blobs VALUES (?, ?, ?)",
+                (filename, size, time.time()))
+            self.db.execute(
+                "INSERT OR REPLACE INTO urls VALUES (?, ?)", (url, filename))
+            self._evict()
+        return filename
+
+    def fetch(self, url, download, suffix=''):
+        """
+        Returns the name of the file downloaded from `url`, calling
+        `download(url)` for the content's chunks if it isn't in the cache.
+        """
+        filename = self.get(url)
+        if filename is None:
+            filename = self.put(url, download(url), suffix)
+        return filename
+
+    def _evict(self):
+        if self.max_size is None:
+            return
+        total, = self.db.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM blobs").fetchone()
+        candidates = self.db.execute(
+            "SELECT filename, size FROM blobs WHERE last_used < ? "
+            "ORDER BY last_used", (self.opened_at,)).fetchall()
+        for filename, size in candidates:
+            if total <= self.max_size:
+                break
+            if os.path.exists(self.path(filename)):
+                os.remove(self.path(filename))
+            self.db.execute("DELETE FROM urls WHERE filename = ?",
+                            (filename,))
+            self.db.execute("DELETE FROM blobs WHERE filename = ?",
+                            (filename,))
+            total -= size
+
+    def close(self):
+        with self.lock:
+            self.db.close()
@@ -0,0 +1,132 @@
+"""
+A journal of the progress through an input file, so that a run that dies
+part way through can be resumed where it left off.
+"""
+
+import sqlite3
+import threading
+
+
+def add_checkpoint_arguments(parser):
+    """
+    Adds the --checkpoint and --resume arguments to `parser`.
+    """
+    parser.add_argument('--checkpoint',
+                        help='Name of file to record progress through the '
+                        'input in, so that the run can be resumed.')
+    parser.add_argument(
+        '--resume', default=False, action='store_const', const=True,
+        help='Resume from the progress recorded in the --checkpoint file, '
+        'rather than starting from the beginning'
+    )
+
+
+class Checkpoint(object):
+    """
+    Records the identity/messageset pairs that have been processed and the
+    offset into the input file that has been completely processed, in the
+    SQLite database at `path`.
+
+    Progress is only committed to the database every `commit_every` rows,
+    so a crash loses at most that many rows of progress. Recording from
+    several threads at once is safe.
+
+    Rows that aren't done when their offset is passed, like those queued
+    to be retried, are held, and the committed offset doesn't go past the
+    earliest held row until it is recorded or released, so that resuming
+    doesn't skip them.
+    """
+
+    def __init__(self, path, resume=False, commit_every=1000):
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.lock = threading.Lock()
+        self.commit_every = commit_every
+        self.uncommitted = 0
+        # The offset rows have been advanced to, the one last committed,
+        # and the offsets at which rows were held, by identity/messageset
+        self.advanced = None
+        self.committed = None
+        self.held = {}
+        with self.lock, self.db:
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS processed ("
+                "identity TEXT, messageset INTEGER, "
+                "PRIMARY KEY (identity, messageset))")
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS offsets ("
+                "id INTEGER PRIMARY KEY AUTOINCREMENT, offset INTEGER)")
+            if not resume:
+                self.db.execute("DELETE FROM processed")
+                self.db.execute("DELETE FROM offsets")
+        self.advanced = self.committed = self.offset
+
+    @property
+    def offset(self):
+        """
+        The offset into the input file up to which all rows have been
+        processed.
+        """
+        with self.lock:
+            row = self.db.execute(
+                "SELECT offset FROM offsets ORDER BY id DESC LIMIT 1"
+            ).fetchone()
+        return row[0] if row else 0
+
+    def is_processed(self, identity, messageset):
+        with self.lock:
+            row = self.db.execute(
+                "SELECT 1 FROM processed "
+                "WHERE identity = ? AND messageset = ?",
+                (identity, messageset)).fetchone()
+        return row is not None
+
+    def record(self, identity, messageset):
+        """
+        Records that `identity` has been subscribed to `messageset`.
+        """
+        with self.lock:
+            self.db.execute(
+                "INSERT OR IGNORE INTO processed VALUES (?, ?)",
+                (identity, messageset))
+            self.held.pop((identity, messageset), None)
+
+    def hold(self, identity, messageset):
+        """
+        Holds the committed offset before the row for `identity` and
+        `messageset`, which isn't done yet, until it is recorded or
+        released. Must be called before advancing past the row.
+        """
+        with self.lock:
+            self.held.setdefault((identity, messageset), self.advanced)
+
+    def release(self, identity, messageset):
+        """
+        Releases a held row that is done without being processed, like one
+        written to the dead letter file.
+        """
+        with self.lock:
+            self.held.pop((identity, messageset), None)
+
+    def advance(self, offset):
+        """
+        Records that every row before `offset` has been processed.
+        """
+        with self.lock:
+            self.advanced = offset
+            self.uncommitted += 1
+            if self.uncommitted >= self.commit_every:
+                self._commit()
+
+    def _commit(self):
+        offset = min([self.advanced] + list(self.held.values()))
+        if offset != self.committed:
+            self.db.execute("INSERT INTO offsets (offset) VALUES (?)",
+                            (offset,))
+            self.committed = offset
+        self.db.commit()
+        self.uncommitted = 0
+
+    def close(self):
+        with self.lock:
+            self._commit()
+            self.db.close()
@@ -1,83 +1,63 @@
-#!/usr/bin/env python
+#!/usr/bin/env python3
 
 import argparse
-import requests
-import urllib
-import datetime
 import csv
+import os
+
+from blob_cache import BlobCache
+from pipeline import parallel_map
+from messageset_cache import MessagesetCache, add_messageset_cache_arguments
+from seed_services import add_client_arguments, make_sbm_client
 
 IMPORT_DIR = "import_files"
 DOWNLOAD = True
 CREATE = True
 
 parser = argparse.ArgumentParser(description='create 6-8pm message sets.')
-parser.add_argument('--sbm-url', required=True,
-                    help='The url for the Stage Based Messaging service.')
-parser.add_argument('--sbm-token', required=True,
-                    help='The token for the Stage Based Messaging service.')
-
-args = parser.parse_args()
-sbm_url = args.sbm_url
-sbm_token = args.sbm_token
-
-session = requests.Session()
-http = requests.adapters.HTTPAdapter(max_retries=5)
-https = requests.adapters.HTTPAdapter(max_retries=5)
-session.mount('http://', http)
-session.mount('https://', https)
-
-
-def get_messagesets(url, token):
-    headers = {
-        'Authorization': "Token " + token,
-        'Content-Type': "application/json"
-    }
-    r = session.get('%smessageset/' % (url),
-                    headers=headers)
-    r.raise_for_status()
+add_client_arguments(parser)
+parser.add_argument('--concurrency', type=int, default=1,
+                    help='The number of audio files to download at a time.')
+add_messageset_cache_arguments(parser)
+parser.add_argument('--cache-dir', default=IMPORT_DIR,
+                    help='The directory to cache downloaded audio in, across '
+                    'runs. Defaults to the import directory.')
+parser.add_argument('--cache-size', type=int,
+                    help='The size in megabytes to limit the audio cache to. '
+                    'Unlimited by default.')
 
-    messagesets = r.json()
-    return messagesets['results']
 
+args = parser.parse_args()
 
-def get_or_create_messageset(url, token, messageset):
-    headers = {
-        'Authorization': "Token " + token,
-        'Content-Type': "application/json"
-    }
-    r = session.get(
-        '%smessageset/?short_name=%s' % (url, messageset['short_name']),
-        headers=headers)
-
-    r.raise_for_status()
-
-    result = r.json()
-    if result['count'] > 0:
-        return result['results'][0]['id']
-    else:
-        r = session.post(
-            '%smessageset/' % (url),
-            json=messageset,
-            headers=headers)
+sbm = make_sbm_client(args)
+messageset_cache = MessagesetCache(sbm, args.messageset_cache,
+                                   args.messageset_cache_ttl)
 
-        return r.json()['id']
+cache_size = args.cache_size * 1024 * 1024 if args.cache_size else None
+cache = BlobCache(args.cache_dir, cache_size)
 
 
-def get_messages(url, token, set_id):
-    headers = {
-        'Authorization': "Token " + token,
-        'Content-Type': "application/json"
-    }
-    r = session.get('%smessageset/%s/messages' % (url, set_id),
-                    headers=headers)
-    r.raise_for_status()
+def get_or_create_messageset(messageset):
+    existing = messageset_cache.find(messageset['short_name'])
+    if existing is None:
+        # The cache may be older than the messageset
+        existing = next(sbm.get_messagesets(
+            {'short_name': messageset['short_name']}), None)
+    if existing is None:
+        existing = sbm.create_messageset(messageset)
+    messageset_cache.add(existing)
+    return existing['id']
 
-    messages = r.json()
-    return messages['messages']
 
-sets = get_messagesets(sbm_url, sbm_token)
+def download_audio(message):
+    """
+    Returns the path, relative to IMPORT_DIR, of the file for the message's
+    audio. The audio is only downloaded if it isn't already in the cache.
+    """
+    filename = cache.fetch(message['binary_content']['content'],
+                           sbm.download, '.mp3')
+    return os.path.relpath(cache.path(filename), IMPORT_DIR)
 
-opener = urllib.URLopener()
+sets = messageset_cache.all()
 
 for messageset in sets:
     name = messageset['short_name']
@@ -103,17 +83,17 @@ for messageset in sets:
             if "channel" in messageset:
                 new_set['channel'] = messageset['channel']
 
-            new_id = get_or_create_messageset(sbm_url, sbm_token, new_set)
+            new_id = get_or_create_messageset(new_set)
 
-        messages = get_messages(sbm_url, sbm_token, messageset['id'])
-
-        for message in messages:
-            filename = datetime.datetime.now().strftime("%Y%m%d%H%M%S%f.mp3")
-            if DOWNLOAD:
-                opener.retrieve(
-                    message['binary_content']['content'],
-                    '%s/%s' % (IMPORT_DIR, filename))
+        messages = sorted(sbm.get_messageset_messages(messageset['id']),
+                          key=lambda message: message['sequence_number'])
+        if DOWNLOAD:
+            filenames = list(parallel_map(download_audio, messages,
+                                          args.concurrency))
+        else:
+            filenames = [''] * len(messages)
 
+        for message, filename in zip(messages, filenames):
             writer.writerow([
                 new_id,
                 message['sequence_number'],
@@ -122,3 +102,5 @@ for messageset in sets:
                 filename])
 
         f.close()
+
+cache.close()
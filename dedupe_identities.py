@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+"""
+Collapses the rows of an identities file that are for the same identity
+into the last of them, which has the most recent expected_* values, so that
+the scripts don't check or subscribe an identity more than once. Files of
+any size are deduplicated with an external sort, holding only --chunk-size
+rows in memory, and --merge-width files open, at a time. The output is
+sorted by identity.
+"""
+
+import argparse
+import heapq
+import os
+import shutil
+import sys
+import tempfile
+
+from identity_row import IdentityRow, InvalidRow
+from json_codec import dumps
+from pipeline import chunked, read_lines
+
+parser = argparse.ArgumentParser(description='Remove the duplicate rows for '
+                                 'each identity from a file of identities.')
+parser.add_argument('--file', dest='data_file', required=True,
+                    type=argparse.FileType('rb'),
+                    help='Name of file containing the list of identities.')
+parser.add_argument('--output', required=True,
+                    help='Name of file to write the deduplicated identities '
+                    'to.')
+parser.add_argument('--chunk-size', type=int, default=100000,
+                    help='The number of rows to sort in memory at a time.')
+parser.add_argument('--merge-width', type=int, default=100,
+                    help='The most sorted chunks to merge at once, which is '
+                    'how many files are open at a time. More chunks than '
+                    'this are merged in several passes.')
+parser.add_argument('--temp-dir',
+                    help='The directory to write the sorted chunks to. The '
+                    'system\'s temporary directory by default.')
+
+
+def keyed_rows(data_file, invalid):
+    """
+    Yields (key, line) for each row of `data_file`, where the key is the
+    row's identity encoded as JSON, which can't contain the tab that
+    separates it from the line in the sorted chunks. Invalid rows are
+    skipped after calling `invalid` with the offset of the start of their
+    line and their error.
+    """
+    for offset, line in read_lines(data_file):
+        try:
+            row = IdentityRow.parse(line, ('identity',))
+        except InvalidRow as e:
+            invalid(offset - len(line), e)
+            continue
+        if not line.endswith(b'\n'):
+            line += b'\n'
+        yield dumps(row.identity), line
+
+
+def sorted_chunk(rows):
+    """
+    Returns the (key, line) pairs of `rows` sorted by key, keeping only the
+    last line for each key.
+    """
+    latest = {}
+    for key, line in rows:
+        latest[key] = line
+    return sorted(latest.items())
+
+
+def write_chunk(chunk, directory):
+    fd, path = tempfile.mkstemp(suffix='.chunk', dir=directory)
+    with os.fdopen(fd, 'wb') as f:
+        for key, line in chunk:
+            f.write(key + b'\t' + line)
+    return path
+
+
+def read_chunk(path):
+    with open(path, 'rb') as f:
+        for line in f:
+            key, _, line = line.partition(b'\t')
+            yield key, line
+
+
+def latest_pairs(chunks):
+    """
+    Merges the sorted `chunks`, which are in the order they were read from
+    the input, yielding the (key, line) pair with the last line for each
+    key.
+    """
+    previous_key = previous_line = None
+    # Pairs with the same key come out of merge in the order of the chunks
+    for key, line in heapq.merge(*chunks, key=lambda pair: pair[0]):
+        if previous_key is not None and key != previous_key:
+            yield previous_key, previous_line
+        previous_key, previous_line = key, line
+    if previous_key is not None:
+        yield previous_key, previous_line
+
+
+def merge_chunks(paths, directory, width):
+    """
+    Merges the chunk files at `paths`, `width` at a time, into chunk files
+    in `directory`, until there are no more than `width` of them, which are
+    returned in order. Each merge is of consecutive chunks, so the chunks
+    stay in the order they were read from the input.
+    """
+    while len(paths) > width:
+        merged = []
+        for start in range(0, len(paths), width):
+            group = paths[start:start + width]
+            merged.append(write_chunk(
+                latest_pairs([read_chunk(path) for path in group]),
+                directory))
+            for path in group:
+                os.remove(path)
+        paths = merged
+    return paths
+
+
+def invalid_row(offset, error):
+    sys.stdout.write("Row skipped - Offset: %s Error: %s\n" % (offset, error))
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    directory = tempfile.mkdtemp(prefix='dedupe-', dir=args.temp_dir)
+    try:
+        row_count = 0
+        paths = []
+        for rows in chunked(keyed_rows(args.data_file, invalid_row),
+                            args.chunk_size):
+            row_count += len(rows)
+            paths.append(write_chunk(sorted_chunk(rows), directory))
+
+        paths = merge_chunks(paths, directory, args.merge_width)
+        count = 0
+        with open(args.output, 'wb') as output:
+            chunks = [read_chunk(path) for path in paths]
+            for _, line in latest_pairs(chunks):
+                output.write(line)
+                count += 1
+    finally:
+        shutil.rmtree(directory)
+
+    sys.stdout.write("Operation complete. %s Identities written, %s "
+                     "duplicate rows removed.\n" % (count, row_count - count))
@@ -0,0 +1,60 @@
+"""
+Decides which lapsed nurseconnect subscriptions can be renewed, from
+indexes of the existing subscriptions rather than a request per identity.
+"""
+
+
+class ResubscribeEligibility(object):
+    """
+    Checks whether identities whose subscription to `old_messageset` lapsed
+    can be subscribed to `new_messageset`, using the Stage Based Messaging
+    client `sbm`.
+
+    Once `build` has been called, the identities already on the new
+    messageset and those still active on the old one are each known from a
+    single paged scan of their subscriptions. An index isn't built if it
+    would hold more than the `limit` given to `build`, and identities are
+    checked individually against that messageset instead.
+    """
+
+    def __init__(self, sbm, new_messageset, old_messageset):
+        self.sbm = sbm
+        self.new_messageset = new_messageset
+        self.old_messageset = old_messageset
+        self.new_identities = None
+        self.old_active_identities = None
+
+    def build(self, limit=None):
+        self.new_identities = self.sbm.get_subscribed_identities(
+            self.new_messageset, limit)
+        self.old_active_identities = self.sbm.get_subscribed_identities(
+            self.old_messageset, limit, {'active': True})
+
+    def on_new_messageset(self, identity):
+        if self.new_identities is not None:
+            return identity in self.new_identities
+        return self.sbm.subscription_exists({
+            "identity": identity,
+            "messageset": self.new_messageset})
+
+    def on_old_messageset(self, identity):
+        if self.old_active_identities is not None:
+            return identity in self.old_active_identities
+        return self.sbm.subscription_exists({
+            "identity": identity,
+            "messageset": self.old_messageset,
+            "active": True})
+
+    def check(self, identity):
+        """
+        Returns the reason `identity` can't be resubscribed because of their
+        other subscriptions, or None if they can be.
+        """
+        if self.on_new_messageset(identity):
+            return ("already subscribed to messageset %s" %
+                    self.new_messageset)
+        if self.on_old_messageset(identity):
+            return ("still subscribed to old messageset %s" %
+                    self.old_messageset)
+        return None
+
@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+"""
+Creates the subscriptions in a plan file written by one of the scripts'
+--plan option, without making any of the decisions again.
+"""
+
+import argparse
+import sys
+
+from checkpoint import Checkpoint, add_checkpoint_arguments
+from pipeline import chunked, parallel_map
+from plan_file import read_plan
+from retry_queue import RetryQueue
+from seed_services import add_client_arguments, make_sbm_client
+from subscriptions import SubscriptionCreator, add_creation_arguments
+
+
+parser = argparse.ArgumentParser(description='Create the subscriptions in a '
+                                 'plan file.')
+add_client_arguments(parser)
+parser.add_argument('--plan', dest='plan_file', required=True,
+                    type=argparse.FileType('rb'),
+                    help='Name of the plan file to create the subscriptions '
+                    'in.')
+parser.add_argument(
+    '--execute', default=False, action='store_const', const=True,
+    help='Execute the changes, rather than just doing a dry run'
+)
+parser.add_argument('--concurrency', type=int, default=1,
+                    help='The number of requests to make at a time.')
+add_creation_arguments(parser)
+add_checkpoint_arguments(parser)
+
+
+args = parser.parse_args()
+execute = args.execute
+
+sbm = make_sbm_client(args)
+creator = SubscriptionCreator(sbm, execute)
+
+if not execute:
+    sys.stdout.write(
+        "Dry run mode. If you want the actions to be executed, use --execute"
+        "\n")
+
+if args.resume and not args.checkpoint:
+    sys.exit("The --resume argument requires --checkpoint.")
+
+checkpoint = None
+if execute and args.checkpoint:
+    checkpoint = Checkpoint(args.checkpoint, resume=args.resume)
+
+retries = RetryQueue(args.dead_letter, args.retry_attempts)
+
+
+def unprocessed(subscriptions):
+    """
+    Yields the (offset, subscription) pairs from the plan, skipping the
+    subscriptions the checkpoint has recorded as created.
+    """
+    for offset, data in subscriptions:
+        # Plans can be dead letter files from an earlier run
+        data.pop('error_code', None)
+        if checkpoint is None or not checkpoint.is_processed(
+                data['identity'], data['messageset']):
+            yield offset, data
+
+
+def create_batch(batch):
+    """
+    Creates a batch of (offset, subscription) pairs. Returns the pairs with
+    the error for each subscription, or None if it was created.
+    """
+    errors = creator.create_many([data for _, data in batch])
+    return [(offset, data, error)
+            for (offset, data), error in zip(batch, errors)]
+
+
+def failed(data, error_code):
+    return ("Subscription creation failed - Identity: %s Error code: %s\n" %
+            (data['identity'], error_code))
+
+
+def created(data):
+    if checkpoint is not None:
+        checkpoint.record(data['identity'], data['messageset'])
+
+
+subscriptions = unprocessed(read_plan(
+    args.plan_file, checkpoint.offset if checkpoint is not None else 0))
+# Each batch is a single request, so the batches are what is made
+# concurrent
+results = parallel_map(create_batch, chunked(subscriptions, args.batch_size),
+                       args.concurrency)
+count = 0
+for batch in results:
+    for offset, data, error in batch:
+        if error is None:
+            created(data)
+            count += 1
+        elif retries.add(data, data, error):
+            # Keep the checkpoint before it until it has been retried
+            if checkpoint is not None:
+                checkpoint.hold(data['identity'], data['messageset'])
+        else:
+            sys.stdout.write(failed(data, error.response.status_code))
+    if checkpoint is not None:
+        checkpoint.advance(offset)
+
+for _, data, error_code, was_created in retries.retry(
+        creator.create, creator.created, args.concurrency):
+    if error_code is None:
+        created(data)
+        if was_created:
+            count += 1
+    else:
+        if checkpoint is not None:
+            checkpoint.release(data['identity'], data['messageset'])
+        sys.stdout.write(failed(data, error_code))
+retries.close()
+if checkpoint is not None:
+    checkpoint.close()
+
+sys.stdout.write("Operation complete. %s Subscriptions created.\n" % count)
@@ -0,0 +1,80 @@
+"""
+A stand-in for requests.Session that sends requests with httpx, over HTTP/2
+where the service supports it, so that the requests made by many threads at
+once are multiplexed over a few connections rather than each needing its
+own. httpx, with its http2 extra, is only needed for this.
+"""
+
+import requests
+
+try:
+    import httpx
+except ImportError:
+    httpx = None
+
+
+class HttpxResponse(object):
+    """
+    An httpx response, with the parts of the requests.Response interface
+    that the service clients use.
+    """
+
+    def __init__(self, response):
+        self.response = response
+        self.status_code = response.status_code
+        self.headers = response.headers
+        self.url = str(response.url)
+
+    @property
+    def content(self):
+        return self.response.read()
+
+    def iter_content(self, chunk_size=1):
+        try:
+            for chunk in self.response.iter_bytes(chunk_size):
+                yield chunk
+        finally:
+            self.response.close()
+
+    def close(self):
+        self.response.close()
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise requests.HTTPError(
+                "%s Error for url: %s" % (self.status_code, self.url),
+                response=self)
+
+
+class HttpxSession(object):
+    """
+    Sends requests with an httpx client that keeps up to `pool_size`
+    connections alive, and retries connection errors up to `max_retries`
+    times. Like requests, there are no timeouts, and connection errors are
+    raised as requests.ConnectionError, so the clients handle both sessions
+    the same way.
+    """
+
+    def __init__(self, pool_size=10, max_retries=5):
+        if httpx is None:
+            raise ImportError(
+                "The http2 transport requires httpx. Install it with "
+                "`pip install httpx[http2]`.")
+        limits = httpx.Limits(max_connections=pool_size,
+                              max_keepalive_connections=pool_size)
+        self.client = httpx.Client(
+            timeout=None, transport=httpx.HTTPTransport(
+                http2=True, limits=limits, retries=max_retries))
+
+    def request(self, method, url, headers=None, params=None, data=None,
+                stream=False):
+        request = self.client.build_request(method, url, headers=headers,
+                                            params=params, content=data)
+        try:
+            response = self.client.send(request, stream=stream)
+        except httpx.TransportError as e:
+            raise requests.ConnectionError(e)
+        return HttpxResponse(response)
+
+    def close(self):
+        self.client.close()
@@ -0,0 +1,83 @@
+"""
+A compact record for the identities in the scripts' input files.
+"""
+
+from json_codec import loads
+
+# The type each field of an input row must have
+FIELD_TYPES = (
+    ('identity', str),
+    ('language', str),
+    ('current_messageset_id', int),
+    ('current_sequence_number', int),
+    ('expected_messageset_id', int),
+    ('expected_sequence_number', int),
+)
+
+
+class InvalidRow(ValueError):
+    """
+    Raised for an input row that can't be processed.
+    """
+
+
+class IdentityRow(object):
+    """
+    An identity from an input file, with only the fields the scripts use,
+    stored in slots rather than a dict so that large inputs take less
+    memory. Fields that weren't required when the row was parsed may be
+    None.
+
+    Rows can be converted back to dicts with dict(row).
+    """
+
+    __slots__ = tuple(field for field, _ in FIELD_TYPES)
+
+    def __init__(self, identity, language=None, current_messageset_id=None,
+                 current_sequence_number=None, expected_messageset_id=None,
+                 expected_sequence_number=None):
+        self.identity = identity
+        self.language = language
+        self.current_messageset_id = current_messageset_id
+        self.current_sequence_number = current_sequence_number
+        self.expected_messageset_id = expected_messageset_id
+        self.expected_sequence_number = expected_sequence_number
+
+    @classmethod
+    def parse(cls, line, required=('identity', 'language')):
+        """
+        Returns the row for a line of JSON. Raises InvalidRow if it isn't a
+        JSON object, or any of the `required` fields are missing or have
+        the wrong type. The other fields aren't checked, since the caller
+        doesn't use them, and are None if they have the wrong type.
+        """
+        try:
+            obj = loads(line)
+        except ValueError as e:
+            raise InvalidRow("Invalid JSON: %s" % e)
+        if not isinstance(obj, dict):
+            raise InvalidRow("Not a JSON object")
+
+        values = []
+        for field, field_type in FIELD_TYPES:
+            value = obj.get(field)
+            # Decoded JSON has exactly these types, and bools aren't ints
+            if type(value) is not field_type:
+                if field in required:
+                    if value is None:
+                        raise InvalidRow("Missing %s" % field)
+                    raise InvalidRow("Invalid %s: %r" % (field, value))
+                value = None
+            values.append(value)
+        return cls(*values)
+
+    def keys(self):
+        return [field for field in self.__slots__
+                if getattr(self, field) is not None]
+
+    def __getitem__(self, field):
+        return getattr(self, field)
+
+    def __repr__(self):
+        return 'IdentityRow(%s)' % ', '.join(
+            '%s=%r' % (field, getattr(self, field)) for field in self.keys())
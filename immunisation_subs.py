@@ -1,173 +1,295 @@
-#!/usr/bin/env python
+#!/usr/bin/env python3
 
 import argparse
 import json
+import os
 import requests
 import sys
+import threading
 
-session = requests.Session()
-http = requests.adapters.HTTPAdapter(max_retries=5)
-https = requests.adapters.HTTPAdapter(max_retries=5)
-session.mount('http://', http)
-session.mount('https://', https)
+from checkpoint import Checkpoint, add_checkpoint_arguments
+from pipeline import (
+    count_lines, create_batched, map_rows, open_input, parse_shard,
+    read_identities)
+from plan_file import PlanWriter
+from planner import RULES_DIR, RulesPlanner, load_rules, plan_rows
+from messageset_cache import MessagesetCache, add_messageset_cache_arguments
+from retry_queue import RetryQueue
+from seed_services import add_client_arguments, make_sbm_client
+from subscriptions import SubscriptionCreator, add_creation_arguments
 
-
-def create_sub(url, token, data):
-    headers = {
-        'Authorization': "Token " + token,
-        'Content-Type': "application/json"
-    }
-    if execute:
-        resp = session.post(
-            '%ssubscriptions/' % url, headers=headers, json=data)
-        resp.raise_for_status()
-
-
-def sub_exists(url, token, params):
-    headers = {
-        'Authorization': "Token " + token,
-        'Content-Type': "application/json"
-    }
-    if execute:
-        resp = session.get(
-            '%ssubscriptions/' % url, headers=headers, params=params)
-        resp.raise_for_status()
-        if resp.json().get('count') > 0:
-            return True
-    return False
-
-
-def get_messageset_schedule(url, token, messageset_id):
-    headers = {
-        'Authorization': "Token " + token,
-        'Content-Type': "application/json"
-    }
-    resp = session.get('%smessageset/%s' % (url, messageset_id),
-                       headers=headers)
-    resp.raise_for_status()
-    return resp.json()['default_schedule']
+# The fields every input row must have
+REQUIRED_FIELDS = ('identity', 'language', 'current_messageset_id',
+                   'current_sequence_number', 'expected_messageset_id',
+                   'expected_sequence_number')
 
 
 parser = argparse.ArgumentParser(description='Subscribe users to an '
                                  'immunisation message set.')
-parser.add_argument('--sbm-url', required=True,
-                    help='The url for the Stage Based Messaging service.')
-parser.add_argument('--sbm-token', required=True,
-                    help='The token for the Stage Based Messaging service.')
+add_client_arguments(parser)
 parser.add_argument('--messageset-ids', type=int, nargs=4, required=True,
                     help='The ids of the messagesets to subscribe users to. '
                     'They must be in the order users would receive the '
                     'messages.')
-parser.add_argument('--file', dest='data_file', type=argparse.FileType('r'),
+parser.add_argument('--file', dest='data_file', type=argparse.FileType('rb'),
                     help='Name of file containing the list of identities.')
 parser.add_argument('--data', help='List of identities. One per line.')
 parser.add_argument(
     '--execute', default=False, action='store_const', const=True,
     help='Execute the changes, rather than just doing a dry run'
 )
+parser.add_argument('--plan',
+                    help='Name of file to write the subscriptions to create '
+                    'to, as JSON lines of their request bodies, rather than '
+                    'creating them. Existing subscriptions are checked as '
+                    'they are with --execute. The plan can then be carried '
+                    'out with execute_plan.py.')
+parser.add_argument(
+    '--prefetch-subscriptions', default=False, action='store_const',
+    const=True,
+    help='Fetch the existing subscriptions for each messageset once, rather '
+    'than checking each identity. Falls back to checking each identity for '
+    'any messageset that has more subscriptions than there are identities.'
+)
+parser.add_argument('--concurrency', type=int, default=1,
+                    help='The number of identities to process at a time.')
+parser.add_argument('--rules',
+                    default=os.path.join(RULES_DIR, 'immunisation.json'),
+                    help='Name of the JSON file with the catch up rules for '
+                    'the campaign. rules/immunisation.json by default.')
+parser.add_argument('--chunk-size', type=int, default=10000,
+                    help='The number of identities to decide the messagesets '
+                    'for at a time.')
+add_messageset_cache_arguments(parser)
+parser.add_argument('--shard', type=parse_shard,
+                    help='Only process the identities in shard K/N, the Kth '
+                    'of N shards counting from 0, chosen by a hash of the '
+                    'identity. See run_shards.py. With '
+                    '--prefetch-subscriptions, every shard fetches all the '
+                    'subscriptions to the messagesets, so N shards fetch them '
+                    'N times. Each shard falls back to checking each '
+                    'identity if there are more of them than its share of '
+                    'the identities.')
+add_checkpoint_arguments(parser)
+add_creation_arguments(parser)
 
 
 args = parser.parse_args()
-sbm_url = args.sbm_url
-sbm_token = args.sbm_token
 messagesets = args.messageset_ids
 execute = args.execute
 
-if not execute:
+sbm = make_sbm_client(args)
+messageset_cache = MessagesetCache(sbm, args.messageset_cache,
+                                   args.messageset_cache_ttl)
+
+if execute and args.plan:
+    sys.exit("The --plan argument can't be used with --execute.")
+plan_writer = PlanWriter(args.plan) if args.plan else None
+creator = SubscriptionCreator(sbm, execute, plan_writer)
+
+if not execute and plan_writer is None:
     sys.stdout.write(
         "Dry run mode. If you want the actions to be executed, use --execute"
         "\n")
 
-POSTBIRTH_1_MESSAGESETS = [8, 42]
-POSTBIRTH_2_MESSAGESETS = [7, 43]
+try:
+    planner = RulesPlanner(load_rules(args.rules), messagesets)
+except (IOError, ValueError) as e:
+    sys.exit("Problem loading the rules: %s" % e)
 
 message_schedules = {}
 for messageset_id in messagesets:
     try:
-        message_schedules[messageset_id] = get_messageset_schedule(
-            sbm_url, sbm_token, messageset_id)
+        message_schedules[messageset_id] = messageset_cache.get_schedule(
+            messageset_id)
     except requests.HTTPError as e:
         sys.exit("Error retrieving messageset %s: %s" % (messageset_id,
                  e.response.status_code))
 
-if args.data_file:
-    identity_list = args.data_file.readlines()
-elif args.data:
-    identity_list = args.data.split("\n")
-else:
+if not args.data_file and not args.data:
     sys.exit("Either --file or --data argument must be present.")
+if args.resume and not args.checkpoint:
+    sys.exit("The --resume argument requires --checkpoint.")
+
+input_file = open_input(args.data_file, args.data)
+
+checkpoint = None
+if execute and args.checkpoint:
+    checkpoint = Checkpoint(args.checkpoint, resume=args.resume)
+
+retries = RetryQueue(args.dead_letter, args.retry_attempts)
+
+existing_identities = {}
+if args.prefetch_subscriptions and (execute or plan_writer is not None):
+    identity_count = count_lines(input_file, args.shard)
+    for messageset_id in messagesets:
+        try:
+            existing_identities[messageset_id] = (
+                sbm.get_subscribed_identities(messageset_id, identity_count))
+        except requests.HTTPError as e:
+            sys.exit("Problem retrieving existing subscriptions for "
+                     "messageset %s: %s" % (messageset_id,
+                                            e.response.status_code))
+
+existing_lock = threading.Lock()
+pending_identities = set()
 
-count = 0
-for item in identity_list:
-    messageset_id = None
-    identity = json.loads(item)
-    old_set = identity['current_messageset_id']
-    new_set = identity['expected_messageset_id']
-    old_msg = identity['current_sequence_number']
-    new_msg = identity['expected_sequence_number']
-
-    # new position in set 8
-    if new_set in POSTBIRTH_1_MESSAGESETS:
-        if new_msg > 29 and (
-                old_set not in POSTBIRTH_1_MESSAGESETS or old_msg <= 29):
-            messageset_id = messagesets[2]  # send 29
-        elif new_msg > 21 and (
-                old_set not in POSTBIRTH_1_MESSAGESETS or old_msg <= 21):
-            messageset_id = messagesets[1]  # send 21
-        elif new_msg > 13 and (
-                old_set not in POSTBIRTH_1_MESSAGESETS or old_msg <= 13):
-            messageset_id = messagesets[0]  # send 13
-    # new position in set 7
-    elif new_set in POSTBIRTH_2_MESSAGESETS:
-        if new_msg > 36 and (
-                old_set in POSTBIRTH_2_MESSAGESETS or old_msg <= 36):
-            messageset_id = messagesets[3]  # send 36
-        # they didn't receive the last message of set 8
-        elif old_set not in POSTBIRTH_2_MESSAGESETS and old_set != 8:
-            messageset_id = messagesets[2]  # send 29 of 8
-        elif old_set in POSTBIRTH_1_MESSAGESETS and old_msg <= 29:
-            messageset_id = messagesets[2]  # send 29 of 8
-
-    if messageset_id is None:
-        continue
-    try:
-        if sub_exists(
-                args.sbm_url, args.sbm_token, {
-                    'identity': identity['identity'],
-                    'messageset': messageset_id}):
-            sys.stdout.write(
-                "Subscription creation skipped - Identity: %s already "
-                "subscribed to messageset %s\n" % (
-                    identity['identity'], messageset_id))
-            continue
-    except requests.HTTPError as e:
-        sys.stdout.write(
-            "Problem retrieving existing subscriptions - Identity: %s Error "
-            "code: %s\n" % (identity['identity'], e.response.status_code))
-        continue
 
+def process_identity(planned):
+    """
+    Checks whether a single identity needs to be subscribed to the
+    messageset planned for them. Returns the output for the identity, the
+    identity, and the subscription to create for them, if any.
+    """
+    identity, messageset_id = planned
+    existing = existing_identities.get(messageset_id)
+    key = (identity.identity, messageset_id)
     data = {
-        'identity': identity['identity'],
-        'lang': identity['language'],
+        'identity': identity.identity,
+        'lang': identity.language,
         'next_sequence_number': 1,
         'messageset': messageset_id,
         'schedule': message_schedules[messageset_id]
     }
     try:
-        create_sub(args.sbm_url, args.sbm_token, data)
-        count += 1
+        if checkpoint is not None and checkpoint.is_processed(
+                identity.identity, messageset_id):
+            exists = True
+        elif existing is not None:
+            # Claim the identity so that a duplicate row being processed at
+            # the same time doesn't also create a subscription
+            with existing_lock:
+                exists = identity.identity in existing
+                existing.add(identity.identity)
+        else:
+            # Claim the identity until its subscription has been created, so
+            # that a duplicate row in the same batch isn't also subscribed
+            with existing_lock:
+                exists = key in pending_identities
+                pending_identities.add(key)
+            if not exists and creator.exists({
+                    'identity': identity.identity,
+                    'messageset': messageset_id}):
+                with existing_lock:
+                    pending_identities.discard(key)
+                exists = True
+        if exists:
+            if checkpoint is not None:
+                checkpoint.record(identity.identity, messageset_id)
+            return (already_subscribed(identity, messageset_id), identity,
+                    None)
     except requests.HTTPError as e:
-        sys.stdout.write(
-            "Subscription creation failed - Identity: %s Error code: %s\n" % (
-                identity['identity'],
-                e.response.status_code
-            )
-        )
-        continue
-    sys.stdout.write(json.dumps({
-        "identity": identity["identity"],
+        return (check_failed(identity, data, e), identity, None)
+    return ("", identity, data)
+
+
+def check_failed(identity, data, error):
+    """
+    Handles a failure to check whether the identity is already subscribed,
+    returning the output for the identity. Transient failures are queued
+    like failed creations, since the retry checks again before creating
+    the subscription, and the others are written to the dead letter file.
+    """
+    key = (identity.identity, data['messageset'])
+    if retries.add(identity, data, error):
+        if checkpoint is not None:
+            checkpoint.hold(*key)
+        return ""
+    with existing_lock:
+        pending_identities.discard(key)
+    return ("Problem retrieving existing subscriptions - Identity: %s Error "
+            "code: %s\n" % (identity.identity, error.response.status_code))
+
+
+def finish(identity, data, error):
+    """
+    Handles the result of creating the identity's subscription. Returns the
+    output for the identity and whether the subscription was created.
+    Identities that will be retried stay claimed, so that a duplicate row
+    doesn't subscribe them in the meantime, and the checkpoint is held
+    before them until they're done.
+    """
+    key = (identity.identity, data['messageset'])
+    if error is None:
+        with existing_lock:
+            pending_identities.discard(key)
+        return (subscribed(identity, data['messageset']), True)
+    if retries.add(identity, data, error):
+        if checkpoint is not None:
+            checkpoint.hold(*key)
+        return ("", False)
+    existing = existing_identities.get(data['messageset'])
+    with existing_lock:
+        pending_identities.discard(key)
+        if existing is not None:
+            existing.discard(identity.identity)
+    return (failed(identity, error.response.status_code), False)
+
+
+def subscribed(identity, messageset_id):
+    if checkpoint is not None:
+        checkpoint.record(identity.identity, messageset_id)
+    if plan_writer is not None:
+        # The subscription is in the plan instead
+        return ""
+    return json.dumps({
+        "identity": identity.identity,
         "messageset": messageset_id
-    }))
-    sys.stdout.write("\n")
+    }) + "\n"
+
+
+def already_subscribed(identity, messageset_id):
+    return ("Subscription creation skipped - Identity: %s already "
+            "subscribed to messageset %s\n" % (identity.identity,
+                                               messageset_id))
 
-sys.stdout.write("Operation complete. %s Subscriptions created.\n" % count)
+
+def invalid_row(offset, error):
+    sys.stdout.write("Row skipped - Offset: %s Error: %s\n" % (offset, error))
+
+
+def failed(identity, error_code):
+    return "Subscription creation failed - Identity: %s Error code: %s\n" % (
+        identity.identity, error_code)
+
+
+rows = read_identities(input_file,
+                       checkpoint.offset if checkpoint is not None else 0,
+                       REQUIRED_FIELDS, invalid_row, args.shard)
+rows = plan_rows(planner, rows, args.chunk_size)
+results = create_batched(map_rows(process_identity, rows, args.concurrency),
+                         creator.create_many, args.batch_size)
+count = 0
+for offset, (output, identity, data), error in results:
+    if data is not None:
+        output, created = finish(identity, data, error)
+        if created:
+            count += 1
+    sys.stdout.write(output)
+    if checkpoint is not None:
+        checkpoint.advance(offset)
+
+for identity, data, error_code, created in retries.retry(
+        creator.create, creator.created, args.concurrency):
+    if error_code is not None:
+        if checkpoint is not None:
+            checkpoint.release(identity.identity, data['messageset'])
+        sys.stdout.write(failed(identity, error_code))
+    elif created:
+        sys.stdout.write(subscribed(identity, data['messageset']))
+        count += 1
+    else:
+        if checkpoint is not None:
+            checkpoint.record(identity.identity, data['messageset'])
+        sys.stdout.write(already_subscribed(identity, data['messageset']))
+retries.close()
+if checkpoint is not None:
+    checkpoint.close()
+
+if plan_writer is not None:
+    plan_writer.close()
+    sys.stdout.write("Operation complete. %s Subscriptions planned.\n" %
+                     plan_writer.count)
+else:
+    sys.stdout.write("Operation complete. %s Subscriptions created.\n" %
+                     count)
@@ -0,0 +1,33 @@
+"""
+JSON encoding and decoding for input rows and service requests, using
+orjson when it is installed since it is several times faster than the
+standard library, and the json module otherwise.
+"""
+
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+if orjson is not None:
+    def loads(data):
+        return orjson.loads(data)
+
+    def dumps(obj):
+        """
+        Returns `obj` encoded as compact JSON bytes.
+        """
+        return orjson.dumps(obj)
+else:
+    def loads(data):
+        return json.loads(data)
+
+    def dumps(obj):
+        """
+        Returns `obj` encoded as compact JSON bytes.
+        """
+        return json.dumps(obj, separators=(',', ':')).encode('utf-8')
+
@@ -0,0 +1,121 @@
+"""
+A cache of the Stage Based Messaging service's messagesets, shared by the
+scripts and kept on disk between runs.
+"""
+
+import json
+import os
+import threading
+import time
+
+
+def add_messageset_cache_arguments(parser):
+    """
+    Adds the arguments for the file to cache the messagesets in to `parser`.
+    """
+    parser.add_argument('--messageset-cache',
+                        help='Name of file to cache the messagesets in '
+                        'between runs.')
+    parser.add_argument('--messageset-cache-ttl', type=int, default=3600,
+                        help='The number of seconds to reuse the cached '
+                        'messagesets for.')
+
+
+class MessagesetCache(object):
+    """
+    The messagesets of the Stage Based Messaging service that `sbm` is a
+    client for, fetched with a single paged request the first time they're
+    needed.
+
+    If `path` is given, the messagesets are kept in a JSON file there and
+    reused by later runs for up to `ttl` seconds after they were fetched.
+    """
+
+    def __init__(self, sbm, path=None, ttl=3600):
+        self.sbm = sbm
+        self.path = path
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.fetch_lock = threading.Lock()
+        self.messagesets = None
+        self.fetched_at = None
+
+    def load(self):
+        """
+        Returns the messagesets by id, from the file at `path` if it is
+        fresh enough, or from the service otherwise.
+        """
+        with self.lock:
+            if self.messagesets is None:
+                self.messagesets = self.read()
+            if self.messagesets is None:
+                self.messagesets = dict(
+                    (messageset['id'], messageset)
+                    for messageset in self.sbm.get_messagesets())
+                self.fetched_at = time.time()
+                self.write()
+            return self.messagesets
+
+    def read(self):
+        if self.path is None or not os.path.exists(self.path):
+            return None
+        with open(self.path) as f:
+            cached = json.load(f)
+        if (cached['url'] != self.sbm.url or
+                cached['fetched_at'] + self.ttl < time.time()):
+            return None
+        self.fetched_at = cached['fetched_at']
+        return dict((messageset['id'], messageset)
+                    for messageset in cached['messagesets'])
+
+    def write(self):
+        if self.path is None:
+            return
+        # Several processes may share the cache, e.g. the shards of a run
+        tmp_path = '%s.%s.tmp' % (self.path, os.getpid())
+        with open(tmp_path, 'w') as f:
+            json.dump({
+                'url': self.sbm.url,
+                'fetched_at': self.fetched_at,
+                'messagesets': list(self.messagesets.values()),
+            }, f)
+        os.rename(tmp_path, self.path)
+
+    def all(self):
+        return list(self.load().values())
+
+    def get(self, messageset_id):
+        """
+        Returns the messageset with `messageset_id`. Messagesets created
+        since the cache was filled are fetched individually.
+        """
+        messageset = self.load().get(messageset_id)
+        if messageset is None:
+            with self.fetch_lock:
+                messageset = self.messagesets.get(messageset_id)
+                if messageset is None:
+                    messageset = self.sbm.get_messageset(messageset_id)
+                    self.add(messageset)
+        return messageset
+
+    def get_schedule(self, messageset_id):
+        return self.get(messageset_id)['default_schedule']
+
+    def find(self, short_name):
+        """
+        Returns the messageset named `short_name`, or None if there isn't
+        one in the cache.
+        """
+        for messageset in self.load().values():
+            if messageset['short_name'] == short_name:
+                return messageset
+        return None
+
+    def add(self, messageset):
+        """
+        Adds a messageset that was fetched or created outside of the cache.
+        """
+        self.load()
+        with self.lock:
+            self.messagesets[messageset['id']] = messageset
+            self.write()
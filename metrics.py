@@ -0,0 +1,196 @@
+"""
+Timings of the requests made to the services, summarised at the end of a
+run to show where the time went.
+"""
+
+import atexit
+import bisect
+import json
+import re
+import sys
+import threading
+import time
+from array import array
+from collections import OrderedDict
+
+# Upper bounds, in seconds, of the latency histogram's buckets
+BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+ID_SEGMENT = re.compile(r'^(\d+|[0-9a-fA-F-]{32,36})$')
+
+
+def endpoint_name(method, path):
+    """
+    Returns the name to group requests to `path` under, with the ids in it
+    replaced, so that e.g. every identity lookup counts as one endpoint.
+    """
+    segments = ['{id}' if ID_SEGMENT.match(segment) else segment
+                for segment in path.split('/')]
+    return "%s %s" % (method, '/'.join(segments))
+
+
+def percentile(latencies, fraction):
+    if not latencies:
+        return 0.0
+    return latencies[min(len(latencies) - 1, int(len(latencies) * fraction))]
+
+
+class EndpointTimings(object):
+    """
+    The latencies, status codes, response sizes and retries of the
+    requests made to one endpoint.
+    """
+
+    def __init__(self):
+        self.latencies = array('d')
+        self.buckets = [0] * (len(BUCKETS) + 1)
+        self.statuses = {}
+        self.bytes = 0
+        self.retries = 0
+
+    def record(self, status, latency, size, retries):
+        self.latencies.append(latency)
+        self.buckets[bisect.bisect_left(BUCKETS, latency)] += 1
+        status = str(status) if status is not None else 'error'
+        self.statuses[status] = self.statuses.get(status, 0) + 1
+        self.bytes += size
+        self.retries += retries
+
+    def stats(self, elapsed):
+        latencies = sorted(self.latencies)
+        return OrderedDict([
+            ('requests', len(latencies)),
+            ('statuses', dict(sorted(self.statuses.items()))),
+            ('retries', self.retries),
+            ('bytes', self.bytes),
+            ('seconds', sum(latencies)),
+            ('p50', percentile(latencies, 0.5)),
+            ('p95', percentile(latencies, 0.95)),
+            ('p99', percentile(latencies, 0.99)),
+            ('per_second', len(latencies) / elapsed if elapsed else 0.0),
+            ('histogram', OrderedDict(
+                zip([str(bound) for bound in BUCKETS] + ['+Inf'],
+                    self.buckets))),
+        ])
+
+
+class RequestMetrics(object):
+    """
+    Collects the timing of each request made by the service clients, by
+    endpoint. Recording from several threads at once is safe.
+    """
+
+    def __init__(self):
+        self.started = time.time()
+        self.lock = threading.Lock()
+        self.endpoints = {}
+
+    def record(self, endpoint, status, latency, size=0, retries=0):
+        """
+        Records a request to `endpoint` that got a `status` response, or
+        None if there was no response, `latency` seconds after it was first
+        sent and `retries` retries later, with a body of `size` bytes.
+        """
+        with self.lock:
+            timings = self.endpoints.get(endpoint)
+            if timings is None:
+                timings = self.endpoints[endpoint] = EndpointTimings()
+            timings.record(status, latency, size, retries)
+
+    def stats(self):
+        elapsed = time.time() - self.started
+        with self.lock:
+            return OrderedDict([
+                ('elapsed', elapsed),
+                ('endpoints', OrderedDict(
+                    (endpoint, self.endpoints[endpoint].stats(elapsed))
+                    for endpoint in sorted(self.endpoints))),
+            ])
+
+    def summary(self):
+        """
+        Returns a human readable summary of the requests made to each
+        endpoint.
+        """
+        stats = self.stats()
+        lines = ["Requests made in %.1fs:" % stats['elapsed']]
+        for endpoint, endpoint_stats in stats['endpoints'].items():
+            lines.append(
+                "  %s: %d requests (%.1f/s), %d retries, %d bytes, "
+                "p50 %.3fs, p95 %.3fs, p99 %.3fs, statuses %s" % (
+                    endpoint, endpoint_stats['requests'],
+                    endpoint_stats['per_second'], endpoint_stats['retries'],
+                    endpoint_stats['bytes'], endpoint_stats['p50'],
+                    endpoint_stats['p95'], endpoint_stats['p99'],
+                    ', '.join('%s: %d' % status for status in
+                              endpoint_stats['statuses'].items())))
+            total = endpoint_stats['requests']
+            for bound, count in endpoint_stats['histogram'].items():
+                if not count:
+                    continue
+                lines.append("    <= %5ss %7d %s" % (
+                    bound, count, '#' * int(40.0 * count / total)))
+        return '\n'.join(lines) + '\n'
+
+    def to_json(self):
+        return json.dumps(self.stats(), indent=2) + '\n'
+
+    def to_prometheus(self):
+        """
+        Returns the metrics in the Prometheus text exposition format.
+        """
+        stats = self.stats()
+        lines = [
+            "# TYPE seed_request_duration_seconds histogram",
+        ]
+        for endpoint, endpoint_stats in stats['endpoints'].items():
+            label = 'endpoint="%s"' % endpoint
+            cumulative = 0
+            for bound, count in endpoint_stats['histogram'].items():
+                cumulative += count
+                lines.append(
+                    'seed_request_duration_seconds_bucket{%s,le="%s"} %d' % (
+                        label, bound, cumulative))
+            lines.append('seed_request_duration_seconds_sum{%s} %f' % (
+                label, endpoint_stats['seconds']))
+            lines.append('seed_request_duration_seconds_count{%s} %d' % (
+                label, endpoint_stats['requests']))
+        lines.append("# TYPE seed_requests_total counter")
+        for endpoint, endpoint_stats in stats['endpoints'].items():
+            for status, count in endpoint_stats['statuses'].items():
+                lines.append('seed_requests_total{endpoint="%s",status="%s"} '
+                             '%d' % (endpoint, status, count))
+        for name, key in (('seed_request_retries_total', 'retries'),
+                          ('seed_response_bytes_total', 'bytes')):
+            lines.append("# TYPE %s counter" % name)
+            for endpoint, endpoint_stats in stats['endpoints'].items():
+                lines.append('%s{endpoint="%s"} %d' % (
+                    name, endpoint, endpoint_stats[key]))
+        return '\n'.join(lines) + '\n'
+
+    def report(self, summary=True, path=None, format='json'):
+        """
+        Writes the summary to stderr if `summary` is set, and the metrics
+        to the file at `path` in `format`, 'json' or 'prometheus', if it is
+        given.
+        """
+        if summary:
+            sys.stderr.write(self.summary())
+        if path is not None:
+            with open(path, 'w') as f:
+                if format == 'prometheus':
+                    f.write(self.to_prometheus())
+                else:
+                    f.write(self.to_json())
+
+
+def make_metrics(summary=False, path=None, format='json'):
+    """
+    Returns RequestMetrics that are reported when the script exits, or None
+    if no report is wanted.
+    """
+    if not summary and path is None:
+        return None
+    metrics = RequestMetrics()
+    atexit.register(metrics.report, summary, path, format)
+    return metrics
@@ -1,80 +1,23 @@
-#!/usr/bin/env python
+#!/usr/bin/env python3
 
 import argparse
 import requests
 import sys
-
-session = requests.Session()
-http = requests.adapters.HTTPAdapter(max_retries=5)
-https = requests.adapters.HTTPAdapter(max_retries=5)
-session.mount('http://', http)
-session.mount('https://', https)
-
-
-def create_sub(url, token, data):
-    headers = {
-        'Authorization': "Token " + token,
-        'Content-Type': "application/json"
-    }
-    resp = session.post('%ssubscriptions/' % url, headers=headers, json=data)
-    resp.raise_for_status()
-
-
-def sub_exists(url, token, params):
-    headers = {
-        'Authorization': "Token " + token,
-        'Content-Type': "application/json"
-    }
-    resp = session.get('%ssubscriptions/' % url, headers=headers,
-                       params=params)
-    resp.raise_for_status()
-    if resp.json().get('count') > 0:
-        return True
-    return False
-
-
-def get_subs(url, token, params):
-    next_url = '%ssubscriptions/' % url
-    while next_url is not None:
-        headers = {
-            'Authorization': "Token " + token,
-            'Content-Type': "application/json"
-        }
-        resp = session.get(next_url, headers=headers, params=params)
-        resp.raise_for_status()
-        for result in resp.json().get('results'):
-            yield result
-        next_url = resp.json().get('next')
-
-
-def get_messageset_schedule(url, token, messageset_id):
-    headers = {
-        'Authorization': "Token " + token,
-        'Content-Type': "application/json"
-    }
-    resp = session.get('%smessageset/%s' % (url, messageset_id),
-                       headers=headers)
-    resp.raise_for_status()
-    return resp.json()['default_schedule']
-
-
-def get_identity(url, token, identity_id):
-    headers = {
-        'Authorization': "Token " + token,
-        'Content-Type': "application/json"
-    }
-    resp = session.get('%sidentities/%s' % (url, identity_id),
-                       headers=headers)
-    resp.raise_for_status()
-    return resp.json()
-
+import time
+
+from eligibility import ResubscribeEligibility
+from messageset_cache import MessagesetCache, add_messageset_cache_arguments
+from pipeline import chunked, parallel_map
+from rate_limit import backoff_delay
+from retry_queue import TRANSIENT_ERRORS, RetryQueue
+from seed_services import (
+    IdentityStoreApiClient, add_client_arguments, make_client,
+    make_sbm_client)
+from subscriptions import SubscriptionCreator, add_creation_arguments
 
 parser = argparse.ArgumentParser(description='Re-subscribe expired '
                                  'nurseconnect users')
-parser.add_argument('--sbm-url', required=True,
-                    help='The url for the Stage Based Messaging service.')
-parser.add_argument('--sbm-token', required=True,
-                    help='The token for the Stage Based Messaging service.')
+add_client_arguments(parser)
 parser.add_argument('--is-url', required=True,
                     help='The url for the Identity Store.')
 parser.add_argument('--is-token', required=True,
@@ -83,70 +26,201 @@ parser.add_argument('--new-messageset', type=int, required=True,
                     help='The id of the new nurseconnect messageset.')
 parser.add_argument('--old-messageset', type=int, required=True,
                     help='The id of the old nurseconnect messageset.')
+add_messageset_cache_arguments(parser)
+parser.add_argument('--prefetch-pages', type=int, default=2,
+                    help='The number of pages of lapsed subscriptions to '
+                    'fetch ahead of the ones being processed.')
+add_creation_arguments(parser)
+parser.add_argument('--concurrency', type=int, default=1,
+                    help='The number of identities to look up at a time.')
+parser.add_argument(
+    '--prefetch-subscriptions', default=False, action='store_const',
+    const=True,
+    help='Fetch the existing subscriptions for the new messageset and the '
+    'active ones for the old messageset once each, rather than checking '
+    'each identity. Falls back to checking each identity against a '
+    'messageset with more subscriptions than there are lapsed '
+    'subscriptions.'
+)
+
 
 args = parser.parse_args()
 new_messageset = args.new_messageset
 old_messageset = args.old_messageset
-sbm_url = args.sbm_url
-sbm_token = args.sbm_token
-is_url = args.is_url
-is_token = args.is_token
+
+sbm = make_sbm_client(args)
+creator = SubscriptionCreator(sbm, execute=True)
+messageset_cache = MessagesetCache(sbm, args.messageset_cache,
+                                   args.messageset_cache_ttl)
+identity_store = make_client(IdentityStoreApiClient, args.is_url,
+                             args.is_token, args, sbm.metrics)
 
 try:
-    messageset_schedule = get_messageset_schedule(sbm_url, sbm_token,
-                                                  new_messageset)
+    messageset_schedule = messageset_cache.get_schedule(new_messageset)
 except requests.HTTPError as e:
     sys.exit("Problem retrieving messageset %s: %s" % (new_messageset,
                                                        e.response.status_code))
 
-# get all nurseconnect subscriptions that have lapsed
-subscriptions = get_subs(sbm_url, sbm_token, {"messageset": old_messageset,
-                                              "completed": True})
-count = 0
-for sub in subscriptions:
+lapsed_params = {"messageset": old_messageset, "completed": True}
+
+eligibility = ResubscribeEligibility(sbm, new_messageset, old_messageset)
+if args.prefetch_subscriptions:
     try:
-        # check they aren't already subscribed to the new messageset
-        if sub_exists(sbm_url, sbm_token, {"identity": sub['identity'],
-                                           "messageset": new_messageset}):
-            sys.stdout.write("Subscription creation skipped - Identity: %s "
-                             "already subscribed to messageset %s\n" %
-                             (sub['identity'], new_messageset))
-            continue
+        eligibility.build(sbm.count_subscriptions(lapsed_params))
+    except requests.HTTPError as e:
+        sys.exit("Problem retrieving existing subscriptions: %s" %
+                 e.response.status_code)
 
-        # check they aren't still subscribed to the old messageset
-        if sub_exists(sbm_url, sbm_token, {"identity": sub['identity'],
-                                           "messageset": old_messageset,
-                                           "active": True}):
-            sys.stdout.write("Subscription creation skipped - Identity: %s "
-                             "still subscribed to old messageset %s\n" %
-                             (sub['identity'], old_messageset))
-            continue
+# whether each identity looked up so far has opted out, by identity id
+opted_out = {}
 
-        # check they haven't opted out
-        identity = get_identity(is_url, is_token, sub['identity'])
-        msisdns = identity['details'].get('addresses', {}).get('msisdn', {})
-        if all(msisdn.get('optedout') for _, msisdn in msisdns.items()):
-            sys.stdout.write("Subscription creation skipped - Identity: %s "
-                             "optedout\n" % (sub['identity']))
-            continue
-    except requests.HTTPError as e:
-        sys.stdout.write("Problem retrieving identity or subscriptions - "
-                         "Subscription: %s Error code: %s\n" %
-                         (sub['id'], e.response.status_code))
-        continue
-
-    data = {
-        'identity': identity['id'],
-        'lang': 'eng_ZA',
-        'next_sequence_number': 1,
-        'messageset': new_messageset,
-        'schedule': messageset_schedule
-    }
+
+def get_opted_out(identity_id):
     try:
-        create_sub(args.sbm_url, args.sbm_token, data)
-        count += 1
+        identity = identity_store.get_identity(identity_id)
     except requests.HTTPError as e:
-        sys.stdout.write("Subscription creation failed - Identity: %s Error "
-                         "code: %s\n" % (identity['identity'],
-                                         e.response.status_code))
+        return e
+    msisdns = identity['details'].get('addresses', {}).get('msisdn', {})
+    return all(msisdn.get('optedout') for _, msisdn in msisdns.items())
+
+
+def resolve_opted_out(identity_ids):
+    """
+    Looks up whether each of `identity_ids` that isn't already in
+    `opted_out` has opted out, `args.concurrency` identities at a time.
+    Returns the errors for those that couldn't be looked up, by identity id.
+    """
+    missing = []
+    for identity_id in identity_ids:
+        if identity_id not in opted_out and identity_id not in missing:
+            missing.append(identity_id)
+
+    errors = {}
+    results = parallel_map(get_opted_out, missing, args.concurrency)
+    for identity_id, result in zip(missing, results):
+        if isinstance(result, requests.HTTPError):
+            errors[identity_id] = result
+        else:
+            opted_out[identity_id] = result
+    return errors
+
+
+def failed(sub, error_code):
+    return ("Subscription creation failed - Identity: %s Error code: %s\n" %
+            (sub['identity'], error_code))
+
+
+def problem(sub, e):
+    return ("Problem retrieving identity or subscriptions - Subscription: %s "
+            "Error code: %s\n" % (sub['id'], e.response.status_code))
+
+
+def check_failed(sub, error, rechecks):
+    """
+    Handles a failure to check whether the lapsed subscription `sub` should
+    be renewed, returning the output for it. Transient failures are added
+    to `rechecks`, to be checked again once the rest are done, and the
+    others are written to the dead letter file.
+    """
+    if error.response.status_code in TRANSIENT_ERRORS:
+        rechecks.append((sub, error))
+        return ""
+    retries.fail(sub, error.response.status_code)
+    return problem(sub, error)
+
+
+def resubscribe(batch, rechecks):
+    """
+    Checks a batch of lapsed subscriptions, and resubscribes the identities
+    that should be. Returns the number of subscriptions created.
+    """
+    count = 0
+    skipped = []
+    for sub in batch:
+        try:
+            reason = eligibility.check(sub['identity'])
+        except requests.HTTPError as e:
+            skipped.append(check_failed(sub, e, rechecks))
+            continue
+        if reason is None:
+            skipped.append(None)
+        else:
+            skipped.append("Subscription creation skipped - Identity: %s "
+                           "%s\n" % (sub['identity'], reason))
+
+    # check they haven't opted out
+    errors = resolve_opted_out([
+        sub['identity'] for sub, output in zip(batch, skipped)
+        if output is None])
+
+    subscriptions = []
+    for i, sub in enumerate(batch):
+        if skipped[i] is not None:
+            continue
+        if sub['identity'] in errors:
+            skipped[i] = check_failed(sub, errors[sub['identity']], rechecks)
+        elif opted_out[sub['identity']]:
+            skipped[i] = ("Subscription creation skipped - Identity: %s "
+                          "optedout\n" % (sub['identity']))
+        elif sub['identity'] in resubscribed:
+            skipped[i] = ("Subscription creation skipped - Identity: %s "
+                          "already subscribed to messageset %s\n" %
+                          (sub['identity'], new_messageset))
+        else:
+            # identities are claimed before they're created, so that a
+            # duplicate in the same batch isn't also resubscribed
+            resubscribed.add(sub['identity'])
+            subscriptions.append({
+                'identity': sub['identity'],
+                'lang': 'eng_ZA',
+                'next_sequence_number': 1,
+                'messageset': new_messageset,
+                'schedule': messageset_schedule
+            })
+
+    created = zip(subscriptions, creator.create_many(subscriptions))
+    for sub, output in zip(batch, skipped):
+        if output is not None:
+            sys.stdout.write(output)
+            continue
+        data, error = next(created)
+        if error is None:
+            count += 1
+        elif not retries.add(sub, data, error):
+            resubscribed.discard(sub['identity'])
+            sys.stdout.write(failed(sub, error.response.status_code))
+    return count
+
+
+# get all nurseconnect subscriptions that have lapsed
+subscriptions = sbm.get_subscriptions(lapsed_params,
+                                      prefetch_pages=args.prefetch_pages)
+# identities resubscribed by this run
+resubscribed = set()
+retries = RetryQueue(args.dead_letter, args.retry_attempts)
+count = 0
+rechecks = []
+for batch in chunked(subscriptions, args.batch_size):
+    count += resubscribe(batch, rechecks)
+
+# check the lapsed subscriptions that couldn't be checked again, backing
+# off between attempts as the retries do
+for attempt in range(args.retry_attempts):
+    if not rechecks:
+        break
+    time.sleep(backoff_delay(attempt, retries.backoff, retries.max_delay))
+    pending, rechecks = rechecks, []
+    for batch in chunked([sub for sub, _ in pending], args.batch_size):
+        count += resubscribe(batch, rechecks)
+for sub, error in rechecks:
+    retries.fail(sub, error.response.status_code)
+    sys.stdout.write(problem(sub, error))
+
+for sub, data, error_code, created in retries.retry(
+        creator.create, creator.created, args.concurrency):
+    if error_code is not None:
+        sys.stdout.write(failed(sub, error_code))
+    elif created:
+        count += 1
+retries.close()
 sys.stdout.write("Operation complete. %s Subscriptions created.\n" % count)
@@ -0,0 +1,258 @@
+"""
+Helpers shared by the scripts for processing lists of identities.
+"""
+
+import argparse
+import io
+import re
+import threading
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from queue import Full, Queue
+
+from identity_row import IdentityRow, InvalidRow
+
+
+def open_input(data_file=None, data=None):
+    """
+    Returns `data_file`, or a file containing the `data` string if there is
+    no file. `data_file` should be opened in binary mode so that offsets
+    into it are byte offsets.
+    """
+    if data_file is None:
+        data_file = io.BytesIO(data.encode('utf-8'))
+    return data_file
+
+
+def read_lines(data_file, offset=0):
+    """
+    Yields each line of `data_file` from `offset` bytes in, one at a time
+    rather than reading them all into memory first, along with the offset
+    of the end of the line. Blank lines are skipped.
+    """
+    if offset:
+        if data_file.seekable():
+            data_file.seek(offset)
+        else:
+            remaining = offset
+            while remaining:
+                chunk = data_file.read(min(remaining, io.DEFAULT_BUFFER_SIZE))
+                if not chunk:
+                    return
+                remaining -= len(chunk)
+    for line in data_file:
+        offset += len(line)
+        if line.strip():
+            yield offset, line
+
+
+def count_lines(data_file, shard=None):
+    """
+    Returns the number of lines that read_lines would yield, rewinding
+    `data_file` afterwards. Returns None if `data_file` can't be rewound.
+    If `shard` is given as an (index, count) pair, returns the number one
+    shard's share of them would be.
+    """
+    if not data_file.seekable():
+        return None
+    position = data_file.tell()
+    count = sum(1 for _ in read_lines(data_file))
+    data_file.seek(position)
+    if shard is not None:
+        count //= shard[1]
+    return count
+
+
+def parse_shard(value):
+    """
+    Parses a shard given as "K/N", meaning the Kth of N shards counting
+    from 0, into an (index, count) pair. For use as an argparse type.
+    """
+    try:
+        index, count = [int(part) for part in value.split('/')]
+    except ValueError:
+        raise argparse.ArgumentTypeError(
+            "%r is not of the form K/N" % value)
+    if not 0 <= index < count:
+        raise argparse.ArgumentTypeError(
+            "The shard index must be from 0 to %s" % (count - 1))
+    return index, count
+
+
+def shard_of(identity, count):
+    """
+    Returns the index of the shard, of `count` shards, that `identity`
+    belongs to. This is stable across processes and hosts, unlike hash().
+    """
+    return zlib.crc32(identity.encode('utf-8')) % count
+
+
+# An "identity" key with a string value
+IDENTITY_PATTERN = re.compile(rb'"identity"\s*:\s*"([^"]*)"')
+
+
+def line_shard(line, count):
+    """
+    Returns the index of the shard, of `count` shards, that the identity on
+    `line` belongs to, found without decoding the line's JSON, or None if
+    it can't be found that way: if the line has escapes in it, the identity
+    isn't a string, or "identity" appears more than once on the line.
+    """
+    # Without escapes, every "identity" on the line is a key or a whole
+    # string value, and a single key is the top level identity unless the
+    # row has none
+    if b'\\' in line or line.count(b'"identity"') != 1:
+        return None
+    match = IDENTITY_PATTERN.search(line)
+    if match is None:
+        return None
+    # The same as shard_of, since these are the identity's UTF-8 bytes
+    return zlib.crc32(match.group(1)) % count
+
+
+def read_identities(data_file, offset=0, required=('identity', 'language'),
+                    invalid=None, shard=None):
+    """
+    Yields the identities in `data_file`, parsed from one JSON object per
+    line into IdentityRows with the `required` fields, along with the
+    offset of the end of each one's line.
+
+    Invalid rows are skipped after calling `invalid` with the offset of the
+    start of their line, where they can be found in the file, and the
+    InvalidRow error, or raise the error if there is no `invalid` callback.
+
+    If `shard` is given as an (index, count) pair, only the identities in
+    that shard are yielded, so that every row of an identity is handled by
+    the same one of several processes. The other shards' rows are skipped
+    before they're decoded where line_shard can tell whose they are. An
+    invalid row is only passed to `invalid` by the shard line_shard gives
+    for it, or by shard 0 if there is none, so that it's reported once.
+    """
+    index = None
+    for offset, line in read_lines(data_file, offset):
+        if shard is not None:
+            index = line_shard(line, shard[1])
+            if index is not None and index != shard[0]:
+                continue
+        try:
+            identity = IdentityRow.parse(line, required)
+        except InvalidRow as e:
+            if index is None and shard is not None and shard[0] != 0:
+                continue
+            if invalid is None:
+                raise
+            invalid(offset - len(line), e)
+            continue
+        if index is None and shard is not None and (
+                shard_of(identity.identity, shard[1]) != shard[0]):
+            continue
+        yield offset, identity
+
+
+def chunked(items, size):
+    """
+    Yields lists of up to `size` of `items` at a time.
+    """
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def parallel_map(func, items, concurrency=1):
+    """
+    Calls `func` for each of `items` on a pool of `concurrency` threads and
+    yields the results in the same order as the items. At most twice
+    `concurrency` items are in flight at a time, so `items` can be a
+    generator.
+    """
+    if concurrency <= 1:
+        for item in items:
+            yield func(item)
+        return
+
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        pending = deque()
+        for item in items:
+            pending.append(pool.submit(func, item))
+            if len(pending) >= 2 * concurrency:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def map_rows(func, rows, concurrency=1):
+    """
+    Like parallel_map, but for the (offset, item) pairs yielded by
+    read_identities. Yields (offset, result) pairs.
+    """
+    def call(row):
+        offset, item = row
+        return offset, func(item)
+    return parallel_map(call, rows, concurrency)
+
+
+def create_batched(results, create, batch_size):
+    """
+    Takes the (offset, result) pairs yielded by map_rows, where the last
+    item of each result is the data to create for it, or None, and creates
+    it `batch_size` results at a time by calling `create` with a list of
+    the batch's data. `create` returns the error for each item of the list,
+    or None if it was created. Yields (offset, result, error) for each
+    result in order.
+    """
+    for batch in chunked(results, batch_size):
+        errors = iter(create([result[-1] for _, result in batch
+                              if result[-1] is not None]))
+        for offset, result in batch:
+            error = next(errors) if result[-1] is not None else None
+            yield offset, result, error
+
+
+def prefetch(items, size):
+    """
+    Yields each of `items`, which are taken from the iterable in a
+    background thread up to `size` items ahead of the consumer. Exceptions
+    raised by the iterable are raised to the consumer.
+    """
+    queue = Queue(maxsize=size)
+    stopped = threading.Event()
+    done = object()
+
+    def put(item):
+        while not stopped.is_set():
+            try:
+                queue.put(item, timeout=0.1)
+                return True
+            except Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            for item in items:
+                if not put((item, None)):
+                    return
+        except Exception as e:
+            put((done, e))
+        else:
+            put((done, None))
+
+    thread = threading.Thread(target=produce)
+    thread.daemon = True
+    thread.start()
+    try:
+        while True:
+            item, error = queue.get()
+            if error is not None:
+                raise error
+            if item is done:
+                return
+            yield item
+    finally:
+        stopped.set()
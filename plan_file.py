@@ -0,0 +1,49 @@
+"""
+Plan files, holding the subscriptions that a run decided to create as JSON
+lines of their request bodies, so that they can be reviewed before being
+created by execute_plan.py without any of the decisions being made again.
+"""
+
+import threading
+
+from json_codec import dumps, loads
+from pipeline import read_lines
+
+
+class PlanWriter(object):
+    """
+    Writes the subscriptions to create to the plan file at `path`, counting
+    them as it goes. Each identity is only planned to be subscribed to a
+    messageset once, since the duplicate rows of an identity aren't
+    checked against subscriptions that are only in the plan. Writing from
+    several threads at once is safe.
+    """
+
+    def __init__(self, path):
+        self.file = open(path, 'wb')
+        self.lock = threading.Lock()
+        self.planned = set()
+        self.count = 0
+
+    def write(self, subscriptions):
+        with self.lock:
+            for data in subscriptions:
+                key = (data['identity'], data['messageset'])
+                if key in self.planned:
+                    continue
+                self.planned.add(key)
+                self.file.write(dumps(data) + b'\n')
+                self.count += 1
+
+    def close(self):
+        self.file.close()
+
+
+def read_plan(plan_file, offset=0):
+    """
+    Yields the subscriptions in `plan_file`, which should be opened in
+    binary mode, from `offset` bytes in, along with the offset of the end
+    of each one's line.
+    """
+    for offset, line in read_lines(plan_file, offset):
+        yield offset, loads(line)
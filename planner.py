@@ -0,0 +1,306 @@
+"""
+Decides which catch up message set, if any, each identity should be
+subscribed to, a chunk of identities at a time, before any requests are
+made for them.
+"""
+
+import json
+import os
+from collections import OrderedDict
+
+from pipeline import chunked
+
+# The directory of the catch up rules for the scripts
+RULES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'rules')
+
+
+def plan_rows(planner, rows, chunk_size=10000):
+    """
+    Plans the (offset, identity) rows yielded by pipeline.read_identities a
+    chunk at a time, yielding (offset, (identity, action)) for only the rows
+    that need action.
+    """
+    for chunk in chunked(rows, chunk_size):
+        for i, action in planner.plan([identity for _, identity in chunk]):
+            offset, identity = chunk[i]
+            yield offset, (identity, action)
+
+
+# The conditions a catch up rule can put on an identity, and the field
+# each one checks
+CONDITIONS = {
+    'current_messageset': 'current_messageset_id',
+    'current_messageset_not': 'current_messageset_id',
+    'current_sequence_above': 'current_sequence_number',
+    'current_sequence_at_most': 'current_sequence_number',
+    'expected_sequence_above': 'expected_sequence_number',
+    'expected_sequence_at_most': 'expected_sequence_number',
+}
+
+
+class InvalidRules(ValueError):
+    """
+    Raised for catch up rules that can't be compiled.
+    """
+
+
+def load_rules(path):
+    """
+    Returns the catch up rules in the JSON file at `path`.
+    """
+    with open(path) as f:
+        return json.load(f)
+
+
+class RulesPlanner(object):
+    """
+    Plans which of the `messagesets` each identity should be subscribed to,
+    using declarative catch up `rules`, like rules/immunisation.json:
+
+        {"messageset_groups": {"postbirth_1": [8, 42], ...},
+         "rules": [{"expected_messageset": "postbirth_1",
+                    "expected_sequence_above": 29,
+                    "unless": {"current_messageset": "postbirth_1",
+                               "current_sequence_above": 29},
+                    "subscribe_to": 2}, ...]}
+
+    The first rule whose conditions all hold for an identity, and whose
+    `unless` conditions don't all hold, subscribes them to the messageset
+    at its `subscribe_to` index of `messagesets`. The conditions are the
+    keys of CONDITIONS. Messagesets in rules are ids, names of
+    `messageset_groups`, or lists of either.
+
+    The rules are compiled once, indexed by the expected messageset they
+    apply to, so each identity is only checked against the few rules for
+    its expected messageset. Since the rules only depend on the current and
+    expected messagesets and sequence numbers, the decision for each
+    combination of them is kept in a table, of up to `max_decisions`
+    entries, and looked up for the identities with the same ones.
+    """
+
+    max_decisions = 100000
+
+    def __init__(self, rules, messagesets):
+        self.groups = rules.get('messageset_groups', {})
+        self.messagesets = messagesets
+        self.decisions = {}
+        self.rules = {}
+        for number, rule in enumerate(rules.get('rules', []), 1):
+            try:
+                expected = self.messageset_ids(rule['expected_messageset'])
+                compiled = (
+                    self.compile_conditions(rule, ('expected_messageset',
+                                                   'subscribe_to', 'unless',
+                                                   'description')),
+                    self.compile_conditions(rule.get('unless', {})),
+                    self.messageset_at(rule['subscribe_to']))
+            except KeyError as e:
+                raise InvalidRules("Rule %s is missing %s" % (number, e))
+            except (InvalidRules, TypeError) as e:
+                raise InvalidRules("Rule %s: %s" % (number, e))
+            for messageset_id in expected:
+                self.rules.setdefault(messageset_id, []).append(compiled)
+
+    def messageset_ids(self, value):
+        """
+        Returns the set of messageset ids a rule's messageset refers to.
+        """
+        if isinstance(value, list):
+            return frozenset().union(*[self.messageset_ids(v) for v in value])
+        if isinstance(value, str):
+            if value not in self.groups:
+                raise InvalidRules("Unknown messageset group %r" % value)
+            return frozenset(self.groups[value])
+        if isinstance(value, int) and not isinstance(value, bool):
+            return frozenset([value])
+        raise InvalidRules("Invalid messageset %r" % (value,))
+
+    def messageset_at(self, index):
+        """
+        Returns the messageset at a rule's `subscribe_to` index.
+        """
+        if (not isinstance(index, int) or isinstance(index, bool) or
+                not 0 <= index < len(self.messagesets)):
+            raise InvalidRules("Invalid subscribe_to %r" % (index,))
+        return self.messagesets[index]
+
+    def compile_conditions(self, conditions, ignored=()):
+        """
+        Returns (field, check) pairs for `conditions`, where check is called
+        with the identity's value for the field.
+        """
+        compiled = []
+        for name, value in conditions.items():
+            if name in ignored:
+                continue
+            if name not in CONDITIONS:
+                raise InvalidRules("Unknown condition %r" % name)
+            if name == 'current_messageset':
+                check = self.messageset_ids(value).__contains__
+            elif name == 'current_messageset_not':
+                def check(actual, excluded=self.messageset_ids(value)):
+                    return actual not in excluded
+            elif not isinstance(value, int) or isinstance(value, bool):
+                raise InvalidRules("Invalid %s %r" % (name, value))
+            elif name.endswith('_above'):
+                check = value.__lt__
+            else:
+                check = value.__ge__
+            compiled.append((CONDITIONS[name], check))
+        return compiled
+
+    def plan(self, identities):
+        """
+        Returns (index, messageset id) pairs for the `identities` that a
+        rule applies to.
+        """
+        planned = []
+        decisions = self.decisions
+        for i, identity in enumerate(identities):
+            key = (identity.current_messageset_id,
+                   identity.current_sequence_number,
+                   identity.expected_messageset_id,
+                   identity.expected_sequence_number)
+            try:
+                messageset_id = decisions[key]
+            except KeyError:
+                messageset_id = self.plan_identity(identity)
+                if len(decisions) < self.max_decisions:
+                    decisions[key] = messageset_id
+            if messageset_id is not None:
+                planned.append((i, messageset_id))
+        return planned
+
+    def plan_identity(self, identity):
+        rules = self.rules.get(identity.expected_messageset_id, ())
+        for conditions, exceptions, messageset_id in rules:
+            if matches(identity, conditions) and not (
+                    exceptions and matches(identity, exceptions)):
+                return messageset_id
+        return None
+
+
+def matches(identity, conditions):
+    """
+    Returns whether all of the compiled `conditions` hold for `identity`.
+    """
+    for field, check in conditions:
+        if not check(getattr(identity, field)):
+            return False
+    return True
+
+
+def build_important_messages(set_details, max_sequence_number):
+    """
+    Returns a dict mapping each (set id, sequence number) in `set_details`
+    to the number of important messages up to and including that message,
+    and whether that message is important.
+    """
+    important_messages = {}
+    imp_msg_index = 0
+    # Loop through all sets with important messages
+    for key, data in set_details.items():
+        important_seqs = set(data['seq'])
+
+        # loop through ALL messages
+        for seq in range(1, max_sequence_number + 1):
+
+            # If message is important, increase the imp_msg_index
+            important = seq in important_seqs
+            if important:
+                imp_msg_index += 1
+
+            important_messages[(key, seq)] = (imp_msg_index, important)
+    return important_messages
+
+
+class PmtctPlanner(object):
+    """
+    Plans which PMTCT important message set each identity should be
+    subscribed to, and the sequence number to start at, so that they
+    receive the important messages they missed.
+
+    `set_details` is an ordered mapping of the PMTCT message set ids to the
+    sequence numbers of their important messages, `alternate_messagesets`
+    maps other message set ids to the PMTCT ones they mirror, and
+    `new_set_ids` maps the number of important messages to the id of the
+    message set ending with that many.
+    """
+
+    def __init__(self, set_details, alternate_messagesets, new_set_ids,
+                 max_sequence_number=69):
+        self.set_details = set_details
+        self.alternate_messagesets = alternate_messagesets
+        self.new_set_ids = new_set_ids
+        self.important_messages = build_important_messages(
+            set_details, max_sequence_number)
+
+    @classmethod
+    def from_rules(cls, rules, max_sequence_number=69):
+        """
+        Returns the planner for catch up `rules` like rules/pmtct.json, with
+        the message sets and their important messages as an ordered list of
+        [set id, [sequence numbers]], and the alternate message sets and new
+        set ids as objects.
+        """
+        try:
+            set_details = OrderedDict(
+                (set_id, {'seq': seqs})
+                for set_id, seqs in rules['important_messages'])
+            alternate_messagesets = dict(
+                (int(set_id), pmtct_set_id) for set_id, pmtct_set_id
+                in rules.get('alternate_messagesets', {}).items())
+            new_set_ids = dict(
+                (int(count), set_id)
+                for count, set_id in rules['new_set_ids'].items())
+        except (KeyError, TypeError, ValueError) as e:
+            raise InvalidRules("Invalid PMTCT rules: %r" % e)
+        return cls(set_details, alternate_messagesets, new_set_ids,
+                   max_sequence_number)
+
+    def plan(self, identities):
+        """
+        Returns (index, (messageset id, start sequence number)) pairs for the
+        `identities` that missed important messages.
+        """
+        planned = []
+        for i, identity in enumerate(identities):
+            action = self.plan_identity(identity)
+            if action is not None:
+                planned.append((i, action))
+        return planned
+
+    def plan_identity(self, identity):
+        old_set_id = identity.current_messageset_id
+        old_set_id = self.alternate_messagesets.get(old_set_id, old_set_id)
+        new_set_id = identity.expected_messageset_id
+        new_set_id = self.alternate_messagesets.get(new_set_id, new_set_id)
+        old_seq = identity.current_sequence_number
+        new_seq = identity.expected_sequence_number
+
+        # if this is a PMTCT message set
+        if old_set_id not in self.set_details:
+            return None
+        start = None
+        end = None
+
+        # find imp_msg_index where we are starting and ending
+        if (old_set_id, old_seq) in self.important_messages:
+            imp_msg_index, important = self.important_messages[
+                (old_set_id, old_seq)]
+            start = imp_msg_index + 1
+            # If the next message was important we send it
+            if important:
+                start -= 1
+
+        if (new_set_id, new_seq) in self.important_messages:
+            imp_msg_index, important = self.important_messages[
+                (new_set_id, new_seq)]
+            end = imp_msg_index
+            # If the next message is important we don't send it
+            if important:
+                end -= 1
+
+        if start and end and start <= end:
+            return (self.new_set_ids[end], start)
+        return None
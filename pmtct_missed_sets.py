@@ -1,186 +1,193 @@
-#!/usr/bin/env python
+#!/usr/bin/env python3
 
 import argparse
 import json
-import requests
+import os
 import sys
-from collections import OrderedDict
-
-set_details = OrderedDict()
-set_details[3] = {'seq': [8, 15, 24]}  # pmtct_prebirth.patient.1
-set_details[4] = {'seq': [2]}  # pmtct_prebirth.patient.2
-set_details[5] = {'seq': [5]}  # pmtct_prebirth.patient.3
-set_details[1] = {'seq': [6, 15, 17]}  # pmtct_postbirth.patient.1
-# This needs to be here to find the end if the subscription has gone past set 1
-set_details[2] = {'seq': []}  # pmtct_postbirth.patient.2
-
-# Mapping for whatsapp messagesets
-alternate_messagesets = {
-    46: 3,  # whatsapp_pmtct_prebirth.patient.1
-    47: 4,  # whatsapp_pmtct_prebirth.patient.2
-    48: 5,  # whatsapp_pmtct_prebirth.patient.3
-    49: 1,  # whatsapp_pmtct_postbirth.patient.1
-    50: 2,  # whatsapp_pmtct_postbirth.patient.2
-}
-
-# TODO: this should be updated to the correct ids in Prod
-new_set_ids = {
-    1: 25,
-    2: 26,
-    3: 27,
-    4: 28,
-    5: 29,
-    6: 30,
-    7: 31,
-    8: 32,
-}
-
-# This is what the sets will look like in the database, we choose the message
-# set based on where we want to end and start at the first important message
-# the subscription missed.
-
-# 1: 8
-# 2: 8, 15
-# 3: 8, 15, 24
-# 4: 8, 15, 24, 2
-# 5: 8, 15, 24, 2, 5
-# 6: 8, 15, 24, 2, 5, 6
-# 7: 8, 15, 24, 2, 5, 6, 15
-# 8: 8, 15, 24, 2, 5, 6, 15, 17
-
-session = requests.Session()
-http = requests.adapters.HTTPAdapter(max_retries=5)
-https = requests.adapters.HTTPAdapter(max_retries=5)
-session.mount('http://', http)
-session.mount('https://', https)
-
-schedules = {}
-
-
-def create_sub(url, token, data):
-    headers = {
-        'Authorization': "Token " + token,
-        'Content-Type': "application/json"
-    }
-
-    if execute:
-        r = session.post(
-            '%ssubscriptions/' % url, data=json.dumps(data), headers=headers)
-        r.raise_for_status()
-        return r
-
-
-def get_messageset_schedule(url, token, messageset_id):
-    if messageset_id not in schedules:
-        headers = {
-            'Authorization': "Token " + token,
-            'Content-Type': "application/json"
-        }
-        r = session.get('%smessageset/%s' % (url, messageset_id),
-                        headers=headers)
-        r.raise_for_status()
 
-        messageset = r.json()
-        schedules[messageset_id] = messageset['default_schedule']
+from checkpoint import Checkpoint, add_checkpoint_arguments
+from pipeline import (
+    create_batched, map_rows, open_input, parse_shard, read_identities)
+from plan_file import PlanWriter
+from planner import RULES_DIR, PmtctPlanner, load_rules, plan_rows
+from messageset_cache import MessagesetCache, add_messageset_cache_arguments
+from retry_queue import RetryQueue
+from seed_services import add_client_arguments, make_sbm_client
+from subscriptions import SubscriptionCreator, add_creation_arguments
 
-    return schedules[messageset_id]
+# The fields every input row must have
+REQUIRED_FIELDS = ('identity', 'language', 'current_messageset_id',
+                   'current_sequence_number', 'expected_messageset_id',
+                   'expected_sequence_number')
 
 
 parser = argparse.ArgumentParser(description='Subscribe PMTCT users to a'
                                  'important message set.')
-parser.add_argument('--sbm-url', required=True,
-                    help='The url for the Stage Based Messaging service.')
-parser.add_argument('--sbm-token', required=True,
-                    help='The token for the Stage Based Messaging service.')
-parser.add_argument('--file', dest='data_file', type=argparse.FileType('r'),
+add_client_arguments(parser)
+parser.add_argument('--file', dest='data_file', type=argparse.FileType('rb'),
                     help='Name of file containing the list of identities.')
 parser.add_argument('--data', help='List of identities. One per line.')
 parser.add_argument(
     '--execute', default=False, action='store_const', const=True,
     help='Execute the changes, rather than just doing a dry run'
 )
+parser.add_argument('--plan',
+                    help='Name of file to write the subscriptions to create '
+                    'to, as JSON lines of their request bodies, rather than '
+                    'creating them. The plan can then be carried out with '
+                    'execute_plan.py.')
+parser.add_argument('--concurrency', type=int, default=1,
+                    help='The number of identities to process at a time.')
+parser.add_argument('--rules', default=os.path.join(RULES_DIR, 'pmtct.json'),
+                    help='Name of the JSON file with the catch up rules for '
+                    'the campaign. rules/pmtct.json by default.')
+parser.add_argument('--chunk-size', type=int, default=10000,
+                    help='The number of identities to decide the messagesets '
+                    'for at a time.')
+parser.add_argument('--max-sequence-number', type=int, default=69,
+                    help='The highest sequence number in any of the PMTCT '
+                    'message sets.')
+add_messageset_cache_arguments(parser)
+parser.add_argument('--shard', type=parse_shard,
+                    help='Only process the identities in shard K/N, the Kth '
+                    'of N shards counting from 0, chosen by a hash of the '
+                    'identity. See run_shards.py.')
+add_checkpoint_arguments(parser)
+add_creation_arguments(parser)
+
 
 args = parser.parse_args()
-sbm_url = args.sbm_url
-sbm_token = args.sbm_token
 execute = args.execute
 
-if not execute:
+sbm = make_sbm_client(args)
+messageset_cache = MessagesetCache(sbm, args.messageset_cache,
+                                   args.messageset_cache_ttl)
+
+if execute and args.plan:
+    sys.exit("The --plan argument can't be used with --execute.")
+plan_writer = PlanWriter(args.plan) if args.plan else None
+creator = SubscriptionCreator(sbm, execute, plan_writer)
+
+try:
+    planner = PmtctPlanner.from_rules(load_rules(args.rules),
+                                      args.max_sequence_number)
+except (IOError, ValueError) as e:
+    sys.exit("Problem loading the rules: %s" % e)
+
+if not execute and plan_writer is None:
     sys.stdout.write(
         "Dry run mode. If you want the actions to be executed, use --execute"
         "\n")
 
-if args.data_file:
-    identity_list = args.data_file.readlines()
-elif args.data:
-    identity_list = args.data.split("\n")
-
-for item in identity_list:
-    identity = json.loads(item)
-
-    old_set_id = identity['current_messageset_id']
-    old_set_id = alternate_messagesets.get(old_set_id, old_set_id)
-    new_set_id = identity['expected_messageset_id']
-    new_set_id = alternate_messagesets.get(new_set_id, new_set_id)
-    old_seq = identity['current_sequence_number']
-    new_seq = identity['expected_sequence_number']
-
-    # if this is a PMTCT message set
-    if old_set_id in set_details.keys():
-        start = None
-        end = None
-
-        imp_msg_index = 0
-        # Loop through all sets with important messages
-        for key, data in set_details.items():
-
-            # loop through ALL messages
-            for seq in range(1, 70):
-
-                # If message is important, increase the imp_msg_index
-                if seq in data['seq']:
-                    imp_msg_index += 1
-
-                # find imp_msg_index where we are starting and ending
-                if (key == old_set_id and seq == old_seq):
-                    start = imp_msg_index + 1
-                    # If the next message was important we send it
-                    if seq in data['seq']:
-                        start -= 1
-
-                if (key == new_set_id and seq == new_seq):
-                    end = imp_msg_index
-
-                    # If the next message is important we don't send it
-                    if seq in data['seq']:
-                        end -= 1
-
-        if start and end and start <= end:
-            messageset_id = new_set_ids[end]
-
-            schedule_id = get_messageset_schedule(sbm_url, sbm_token,
-                                                  messageset_id)
-
-            data = {
-                'identity': identity['identity'],
-                'lang': identity['language'],
-                'next_sequence_number': start,
-                'messageset': messageset_id,
-                'schedule': schedule_id
-            }
-            try:
-                create_sub(args.sbm_url, args.sbm_token, data)
-            except requests.HTTPError as e:
-                sys.stdout.write("Subscription creation failed - Identity: %s "
-                                 "Error code: %s\n" % (
-                                  identity['identity'], e.response.status_code)
-                                 )
-                continue
-            sys.stdout.write(json.dumps({
-                "identity": identity["identity"],
-                "messageset": messageset_id,
-                "start": start,
-            }))
-            sys.stdout.write("\n")
-
-sys.stdout.write("Operation complete\n")
+if not args.data_file and not args.data:
+    sys.exit("Either --file or --data argument must be present.")
+if args.resume and not args.checkpoint:
+    sys.exit("The --resume argument requires --checkpoint.")
+
+input_file = open_input(args.data_file, args.data)
+
+checkpoint = None
+if execute and args.checkpoint:
+    checkpoint = Checkpoint(args.checkpoint, resume=args.resume)
+
+retries = RetryQueue(args.dead_letter, args.retry_attempts)
+
+
+def process_identity(planned):
+    """
+    Works out the subscription to the important messages planned for a
+    single identity. Returns the output for the identity, the identity, and
+    the subscription to create for them, if any.
+    """
+    identity, (messageset_id, start) = planned
+    if checkpoint is not None and checkpoint.is_processed(
+            identity.identity, messageset_id):
+        return ("", identity, None)
+
+    schedule_id = messageset_cache.get_schedule(messageset_id)
+
+    data = {
+        'identity': identity.identity,
+        'lang': identity.language,
+        'next_sequence_number': start,
+        'messageset': messageset_id,
+        'schedule': schedule_id
+    }
+    return ("", identity, data)
+
+
+def finish(identity, data, error):
+    """
+    Handles the result of creating the identity's subscription. Returns the
+    output for the identity. The checkpoint is held before identities that
+    will be retried until they're done.
+    """
+    if error is None:
+        return subscribed(identity, data)
+    if retries.add(identity, data, error):
+        if checkpoint is not None:
+            checkpoint.hold(identity.identity, data['messageset'])
+        return ""
+    return failed(identity, error.response.status_code)
+
+
+def subscribed(identity, data):
+    if checkpoint is not None:
+        checkpoint.record(identity.identity, data['messageset'])
+    if plan_writer is not None:
+        # The subscription is in the plan instead
+        return ""
+    return json.dumps({
+        "identity": identity.identity,
+        "messageset": data['messageset'],
+        "start": data['next_sequence_number'],
+    }) + "\n"
+
+
+def invalid_row(offset, error):
+    sys.stdout.write("Row skipped - Offset: %s Error: %s\n" % (offset, error))
+
+
+def failed(identity, error_code):
+    return ("Subscription creation failed - Identity: %s "
+            "Error code: %s\n" % (identity.identity, error_code))
+
+
+rows = read_identities(input_file,
+                       checkpoint.offset if checkpoint is not None else 0,
+                       REQUIRED_FIELDS, invalid_row, args.shard)
+rows = plan_rows(planner, rows, args.chunk_size)
+results = create_batched(map_rows(process_identity, rows, args.concurrency),
+                         creator.create_many, args.batch_size)
+count = 0
+for offset, (output, identity, data), error in results:
+    if data is not None:
+        output = finish(identity, data, error)
+        if error is None:
+            count += 1
+    sys.stdout.write(output)
+    if checkpoint is not None:
+        checkpoint.advance(offset)
+
+for identity, data, error_code, created in retries.retry(
+        creator.create, creator.created, args.concurrency):
+    if error_code is not None:
+        if checkpoint is not None:
+            checkpoint.release(identity.identity, data['messageset'])
+        sys.stdout.write(failed(identity, error_code))
+    elif created:
+        sys.stdout.write(subscribed(identity, data))
+        count += 1
+    elif checkpoint is not None:
+        checkpoint.record(identity.identity, data['messageset'])
+retries.close()
+if checkpoint is not None:
+    checkpoint.close()
+
+if plan_writer is not None:
+    plan_writer.close()
+    sys.stdout.write("Operation complete. %s Subscriptions planned.\n" %
+                     plan_writer.count)
+else:
+    sys.stdout.write("Operation complete. %s Subscriptions created.\n" %
+                     count)
@@ -0,0 +1,152 @@
+"""
+Client side rate limiting and backoff, so that the scripts can run as fast
+as a service allows without overloading it.
+"""
+
+import random
+import threading
+import time
+from collections import deque
+from email.utils import parsedate_to_datetime
+
+# Responses that mean the service is overloaded, rather than that the
+# request failed, like a 500 for a bug in handling one identity
+OVERLOAD_STATUSES = frozenset([429, 502, 503, 504])
+
+
+def parse_retry_after(value, now=None):
+    """
+    Returns the number of seconds to wait given by a Retry-After header,
+    which is either a number of seconds or an HTTP date, or None if there
+    isn't one or it can't be parsed.
+    """
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        retry_at = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if now is None:
+        now = time.time()
+    return max(0.0, retry_at.timestamp() - now)
+
+
+def backoff_delay(attempt, backoff=0.5, max_delay=60):
+    """
+    Returns the number of seconds to wait before retry number `attempt`,
+    growing exponentially from `backoff`, with full jitter.
+    """
+    return random.uniform(0, min(max_delay, backoff * 2 ** attempt))
+
+
+def make_rate_limiter(max_rate, max_concurrency, target_latency=1.0):
+    """
+    Returns a RateLimiter, or None if there's no `max_rate` to limit to.
+    """
+    if max_rate is None:
+        return None
+    return RateLimiter(max_rate, max_concurrency, target_latency)
+
+
+class RateLimiter(object):
+    """
+    Limits the requests made to a service to `max_rate` per second, and
+    `max_concurrency` in flight at once.
+
+    Both limits are adjusted additive increase, multiplicative decrease
+    style: they grow by one for every concurrent request's worth of
+    successful responses, and are halved when the service responds with
+    one of the OVERLOAD_STATUSES or not at all, or when the 95th percentile
+    latency of recent requests goes over `target_latency` seconds. Only
+    requests started since the last decrease can cause another, so a burst
+    of errors from requests already in flight only counts once. A
+    Retry-After header pauses all requests for that long.
+
+    Using the limiter from several threads at once is safe.
+    """
+
+    def __init__(self, max_rate, max_concurrency=10, target_latency=1.0,
+                 window=100):
+        self.max_rate = float(max_rate)
+        self.max_concurrency = max_concurrency
+        self.target_latency = target_latency
+        self.rate = self.max_rate
+        self.concurrency = float(max_concurrency)
+        self.tokens = 1.0
+        self.in_flight = 0
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self.decreased_at = 0.0
+        self.latencies = deque(maxlen=window)
+        self.condition = threading.Condition()
+
+    def _refill(self, now):
+        burst = max(1.0, self.concurrency)
+        self.tokens = min(burst,
+                          self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self):
+        """
+        Blocks until a request can be made, and returns the time it was
+        started, to be passed to `release` once it completes.
+        """
+        with self.condition:
+            while True:
+                now = time.monotonic()
+                self._refill(now)
+                if now < self.paused_until:
+                    wait = self.paused_until - now
+                elif self.in_flight >= int(self.concurrency):
+                    wait = None
+                elif self.tokens < 1:
+                    wait = (1 - self.tokens) / self.rate
+                else:
+                    self.tokens -= 1
+                    self.in_flight += 1
+                    return now
+                self.condition.wait(wait)
+
+    def release(self, started, status_code=None, retry_after=None):
+        """
+        Records the response to a request started at `started`, with
+        `status_code`, or None if no response was received, and the
+        Retry-After header's number of seconds if there was one.
+        """
+        with self.condition:
+            now = time.monotonic()
+            self.in_flight -= 1
+            if retry_after:
+                self.paused_until = max(self.paused_until, now + retry_after)
+            if status_code is None or status_code in OVERLOAD_STATUSES:
+                self._decrease(started, now)
+            else:
+                self.latencies.append(now - started)
+                if self._p95() > self.target_latency:
+                    self._decrease(started, now)
+                else:
+                    self._increase()
+            self.condition.notify_all()
+
+    def _p95(self):
+        if len(self.latencies) < self.latencies.maxlen // 5:
+            return 0.0
+        latencies = sorted(self.latencies)
+        return latencies[int(len(latencies) * 0.95)]
+
+    def _increase(self):
+        self.concurrency = min(self.max_concurrency,
+                               self.concurrency + 1.0 / self.concurrency)
+        self.rate = min(self.max_rate, self.rate + 1.0 / self.concurrency)
+
+    def _decrease(self, started, now):
+        if started < self.decreased_at:
+            return
+        self.decreased_at = now
+        self.concurrency = max(1.0, self.concurrency / 2)
+        self.rate = max(1.0, self.rate / 2)
+        self.latencies.clear()
@@ -0,0 +1,109 @@
+"""
+Subscription creations that failed, kept to be retried once the rest of
+the run is done, and written to a dead letter file if they still fail.
+"""
+
+import json
+import threading
+import time
+
+import requests
+
+from pipeline import parallel_map
+from rate_limit import backoff_delay
+
+# Error codes for failures that might succeed if the request is retried
+TRANSIENT_ERRORS = frozenset([408, 429, 500, 502, 503, 504])
+
+
+class RetryQueue(object):
+    """
+    Collects the rows whose subscriptions couldn't be created, along with
+    the subscription data, to retry after the main pass.
+
+    Transient failures are retried up to `attempts` times, waiting a
+    jittered, exponentially growing delay from `backoff` seconds between
+    attempts. Rows that fail permanently, or run out of attempts, are
+    written to the JSON lines file at `path` with their `error_code`, so
+    that the file can be used as the input to another run. Adding rows from
+    several threads at once is safe.
+    """
+
+    def __init__(self, path=None, attempts=3, backoff=1.0, max_delay=60):
+        self.attempts = attempts
+        self.backoff = backoff
+        self.max_delay = max_delay
+        self.lock = threading.Lock()
+        self.pending = []
+        self.dead_letter = open(path, 'a') if path is not None else None
+
+    def add(self, row, data, error):
+        """
+        Queues `row`, whose subscription `data` failed with the HTTPError
+        `error`, to be retried if the failure was transient. Returns whether
+        it will be retried.
+        """
+        error_code = error.response.status_code
+        if self.attempts and error_code in TRANSIENT_ERRORS:
+            with self.lock:
+                self.pending.append((row, data, error_code))
+            return True
+        self.fail(row, error_code)
+        return False
+
+    def fail(self, row, error_code):
+        """
+        Writes `row` to the dead letter file.
+        """
+        if self.dead_letter is None:
+            return
+        with self.lock:
+            self.dead_letter.write(
+                json.dumps(dict(row, error_code=error_code)) + "\n")
+
+    def retry(self, create, exists=None, concurrency=1):
+        """
+        Retries the queued rows by calling `create` with their subscription
+        data, `concurrency` at a time. Yields (row, data, error code,
+        created) for each row once it's done, with an error code of None if
+        the subscription exists now, and created False if it already did.
+
+        Since a request that failed may still have been handled, `exists`
+        is called with the data first if it is given, and a subscription
+        that already exists isn't created again.
+        """
+        def attempt(entry):
+            try:
+                if exists is not None and exists(entry[1]):
+                    return None, False
+                create(entry[1])
+            except requests.HTTPError as e:
+                return e.response.status_code, False
+            return None, True
+
+        for attempt_number in range(self.attempts):
+            with self.lock:
+                pending, self.pending = self.pending, []
+            if not pending:
+                break
+            time.sleep(backoff_delay(attempt_number, self.backoff,
+                                     self.max_delay))
+            results = parallel_map(attempt, pending, concurrency)
+            for (row, data, _), (error_code, created) in zip(pending,
+                                                            results):
+                if error_code in TRANSIENT_ERRORS:
+                    self.pending.append((row, data, error_code))
+                    continue
+                if error_code is not None:
+                    self.fail(row, error_code)
+                yield row, data, error_code, created
+
+        with self.lock:
+            pending, self.pending = self.pending, []
+        for row, data, error_code in pending:
+            self.fail(row, error_code)
+            yield row, data, error_code, False
+
+    def close(self):
+        if self.dead_letter is not None:
+            self.dead_letter.close()
@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+"""
+Runs one of the scripts as several processes, each processing a shard of
+the identities in its input file, and merges their output into one report.
+
+Every row of an identity is in the same shard, so the shards never create
+duplicate subscriptions for an identity between them. To split a run
+between hosts as well, give each host's run a different --shard, and it is
+split further between that host's processes.
+"""
+
+import argparse
+import os
+import re
+import subprocess
+import sys
+import threading
+
+from pipeline import parse_shard
+
+# The script arguments naming files that each shard needs its own one of
+PER_SHARD_ARGS = ('--checkpoint', '--dead-letter', '--metrics-file', '--plan')
+
+COMPLETE = re.compile(r'Operation complete\. (\d+) Subscriptions (\w+)\.')
+
+parser = argparse.ArgumentParser(
+    description='Run a script as several processes, each processing a shard '
+    'of the identities in its input file.',
+    epilog='The %s file names given to the script must contain "{shard}", '
+    'which is replaced with the index of each shard.' % ', '.join(
+        PER_SHARD_ARGS))
+parser.add_argument('--processes', type=int, default=os.cpu_count(),
+                    help='The number of processes to run. The number of '
+                    'CPUs by default.')
+parser.add_argument('--shard', type=parse_shard, default=(0, 1),
+                    help='The shard K/N of the identities to process, when '
+                    'splitting the run between N hosts. Each host\'s shard is '
+                    'split between its processes.')
+parser.add_argument('script',
+                    help='The script to run, e.g. pmtct_missed_sets.py.')
+parser.add_argument('script_args', nargs=argparse.REMAINDER,
+                    help='The arguments to pass to the script.')
+
+
+def check_per_shard_args(script_args):
+    """
+    Returns the first of the PER_SHARD_ARGS in `script_args` whose file
+    name doesn't contain "{shard}", or None if there are none.
+    """
+    for i, arg in enumerate(script_args):
+        name, _, value = arg.partition('=')
+        if name not in PER_SHARD_ARGS:
+            continue
+        if not value and i + 1 < len(script_args):
+            value = script_args[i + 1]
+        if '{shard}' not in value:
+            return name
+    return None
+
+
+class Report(object):
+    """
+    Merges the output of the shards as they write it, passing each line
+    through, except for the dry run notice, which is only written once, and
+    the line with each shard's count of subscriptions created or planned,
+    which are added up.
+    """
+
+    def __init__(self, out):
+        self.out = out
+        self.lock = threading.Lock()
+        self.count = 0
+        self.outcome = 'created'
+        self.dry_run = False
+
+    def read(self, stream):
+        for line in stream:
+            match = COMPLETE.match(line)
+            with self.lock:
+                if match:
+                    self.count += int(match.group(1))
+                    self.outcome = match.group(2)
+                elif line.startswith('Dry run mode'):
+                    if not self.dry_run:
+                        self.out.write(line)
+                    self.dry_run = True
+                else:
+                    self.out.write(line)
+
+
+def run_shard(script, script_args, index, count, report):
+    """
+    Starts the script for a shard, returning the process and the thread
+    reading its output into the `report`.
+    """
+    argv = [sys.executable, script] + [
+        arg.replace('{shard}', str(index)) for arg in script_args
+    ] + ['--shard', '%s/%s' % (index, count)]
+    process = subprocess.Popen(argv, stdout=subprocess.PIPE,
+                               universal_newlines=True)
+    reader = threading.Thread(target=report.read, args=(process.stdout,))
+    reader.start()
+    return process, reader
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    unsharded = check_per_shard_args(args.script_args)
+    if unsharded is not None:
+        parser.error('The %s file name must contain "{shard}", so that each '
+                     'shard has its own file.' % unsharded)
+
+    # Shard K of N split P ways is shards K, K + N, ..., K + N(P - 1) of NP,
+    # since an identity in one of them has a hash that is K modulo N
+    host_index, host_count = args.shard
+    count = host_count * args.processes
+    report = Report(sys.stdout)
+    shards = [
+        (index, run_shard(args.script, args.script_args, index, count,
+                          report))
+        for index in range(host_index, count, host_count)]
+
+    failed = []
+    for index, (process, reader) in shards:
+        process.wait()
+        reader.join()
+        process.stdout.close()
+        if process.returncode != 0:
+            failed.append(index)
+            sys.stderr.write("Shard %s/%s failed with exit code %s\n" % (
+                index, count, process.returncode))
+
+    if failed:
+        sys.exit("%s of %s shards failed. %s Subscriptions %s." % (
+            len(failed), len(shards), report.count, report.outcome))
+    sys.stdout.write("Operation complete. %s Subscriptions %s.\n" % (
+        report.count, report.outcome))
@@ -0,0 +1,350 @@
+"""
+Clients for the Stage Based Messaging and Identity Store services.
+"""
+
+import time
+
+import requests
+from requests.compat import urlsplit
+from urllib3.util.retry import Retry
+
+from httpx_session import HttpxSession
+from json_codec import dumps, loads
+from metrics import endpoint_name, make_metrics
+from pipeline import prefetch
+from rate_limit import backoff_delay, make_rate_limiter, parse_retry_after
+
+# Responses worth retrying, because the service didn't handle the request.
+# Requests that aren't POSTs are also retried for the other gateway errors,
+# and for 500s, which may have been handled, since repeating them is safe.
+RETRY_STATUSES = frozenset([429, 503])
+IDEMPOTENT_RETRY_STATUSES = frozenset([429, 500, 502, 503, 504])
+
+# The ways requests can be sent, for make_session's `transport`
+TRANSPORTS = ('requests', 'http2')
+
+
+def make_session(pool_size=10, max_retries=5, backoff=0.5,
+                 transport='requests'):
+    """
+    Returns a session whose connection pools keep up to `pool_size`
+    connections alive per host, for use by `pool_size` threads at once.
+    Connection errors are retried up to `max_retries` times, with
+    exponential backoff starting at `backoff` seconds.
+
+    The `transport` is one of TRANSPORTS. With 'http2' the session is an
+    HttpxSession, which multiplexes the threads' requests over HTTP/2
+    connections where the service supports it.
+    """
+    if transport == 'http2':
+        return HttpxSession(pool_size, max_retries)
+    session = requests.Session()
+    # responses are retried by SeedServiceApiClient.request instead
+    retry = Retry(total=max_retries, backoff_factor=backoff,
+                  status_forcelist=(), respect_retry_after_header=False)
+    for prefix in ('http://', 'https://'):
+        session.mount(prefix, requests.adapters.HTTPAdapter(
+            max_retries=retry, pool_maxsize=pool_size))
+    return session
+
+
+class SeedServiceApiClient(object):
+    """
+    Base client for a seed service at `url`, authenticated with `token`.
+
+    Requests raise requests.HTTPError for error responses. Responses to
+    requests the service didn't handle, like 429s and 503s, are retried up
+    to `max_retries` times first, waiting as long as their Retry-After
+    header asks, or backing off exponentially from `backoff` seconds. If a
+    `rate_limiter` is given, every request waits for it, and if `metrics`
+    are given, every request is recorded in them. Unless a `session` is
+    given, requests are sent with the `transport` named, one of TRANSPORTS.
+    """
+
+    def __init__(self, url, token, pool_size=10, max_retries=5,
+                 session=None, backoff=0.5, rate_limiter=None, metrics=None,
+                 transport='requests'):
+        self.url = url
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.rate_limiter = rate_limiter
+        self.metrics = metrics
+        self.headers = {
+            'Authorization': "Token " + token,
+            'Content-Type': "application/json"
+        }
+        if session is None:
+            session = make_session(pool_size, max_retries, backoff,
+                                   transport)
+        self.session = session
+
+    def request(self, method, url, headers=None, **kwargs):
+        """
+        Makes a request, retrying responses the service didn't handle, and
+        returns the response. Raises requests.HTTPError for the final
+        response if it is an error.
+        """
+        if method == 'POST':
+            retry_statuses = RETRY_STATUSES
+        else:
+            retry_statuses = IDEMPOTENT_RETRY_STATUSES
+        started = time.time()
+        attempt = 0
+        while True:
+            try:
+                resp = self.send(method, url, headers, **kwargs)
+            except requests.RequestException:
+                self.record(method, url, started, None, attempt)
+                raise
+            if (resp.status_code not in retry_statuses or
+                    attempt >= self.max_retries):
+                break
+            delay = parse_retry_after(resp.headers.get('Retry-After'))
+            if delay is None:
+                delay = backoff_delay(attempt, self.backoff)
+            resp.close()
+            time.sleep(delay)
+            attempt += 1
+        self.record(method, url, started, resp, attempt,
+                    kwargs.get('stream', False))
+        resp.raise_for_status()
+        return resp
+
+    def record(self, method, url, started, resp, retries, stream=False):
+        if self.metrics is None:
+            return
+        if url.startswith(self.url):
+            path = urlsplit(url[len(self.url):]).path
+        else:
+            parts = urlsplit(url)
+            path = parts.netloc + parts.path
+        if resp is None:
+            status, size = None, 0
+        elif stream:
+            status = resp.status_code
+            size = int(resp.headers.get('Content-Length', 0))
+        else:
+            status, size = resp.status_code, len(resp.content)
+        self.metrics.record(endpoint_name(method, path), status,
+                            time.time() - started, size, retries)
+
+    def send(self, method, url, headers=None, **kwargs):
+        if self.rate_limiter is None:
+            return self.session.request(method, url, headers=headers,
+                                        **kwargs)
+        started = self.rate_limiter.acquire()
+        try:
+            resp = self.session.request(method, url, headers=headers,
+                                        **kwargs)
+        except requests.RequestException:
+            self.rate_limiter.release(started)
+            raise
+        self.rate_limiter.release(
+            started, resp.status_code,
+            parse_retry_after(resp.headers.get('Retry-After')))
+        return resp
+
+    def get(self, path, params=None):
+        return loads(self.request('GET', self.url + path,
+                                  headers=self.headers,
+                                  params=params).content)
+
+    def post(self, path, data):
+        return loads(self.request('POST', self.url + path,
+                                  headers=self.headers,
+                                  data=dumps(data)).content)
+
+    def download(self, url, chunk_size=64 * 1024):
+        """
+        Yields the content at `url` in chunks of `chunk_size` bytes, rather
+        than reading it all into memory. The service's authentication
+        headers aren't sent, since `url` may be on another host.
+        """
+        resp = self.request('GET', url, stream=True)
+        return resp.iter_content(chunk_size)
+
+    def get_pages(self, path, params=None, prefetch_pages=0):
+        """
+        Yields each page of a paginated list, following the `next` links.
+        If `prefetch_pages` is given, up to that many pages are fetched in
+        the background while earlier ones are being processed.
+        """
+        if prefetch_pages:
+            return prefetch(self.iter_pages(path, params), prefetch_pages)
+        return self.iter_pages(path, params)
+
+    def iter_pages(self, path, params=None):
+        page = self.get(path, params)
+        while True:
+            yield page
+            if page.get('next') is None:
+                return
+            page = loads(self.request('GET', page['next'],
+                                      headers=self.headers).content)
+
+    def get_paginated(self, path, params=None, prefetch_pages=0):
+        """
+        Yields the results from every page of a paginated list.
+        """
+        for page in self.get_pages(path, params, prefetch_pages):
+            for result in page.get('results'):
+                yield result
+
+
+class StageBasedMessagingApiClient(SeedServiceApiClient):
+
+    def get_messagesets(self, params=None):
+        return self.get_paginated('messageset/', params)
+
+    def get_messageset(self, messageset_id):
+        return self.get('messageset/%s' % messageset_id)
+
+    def create_messageset(self, data):
+        return self.post('messageset/', data)
+
+    def get_messageset_messages(self, messageset_id):
+        return self.get('messageset/%s/messages' % messageset_id)['messages']
+
+    def get_subscriptions(self, params=None, prefetch_pages=0):
+        return self.get_paginated('subscriptions/', params, prefetch_pages)
+
+    def count_subscriptions(self, params=None):
+        return self.get('subscriptions/', params).get('count')
+
+    def subscription_exists(self, params):
+        return self.count_subscriptions(params) > 0
+
+    # Whether the service accepts a list of subscriptions to create. Set to
+    # False once it has rejected one.
+    bulk_create = True
+
+    def create_subscription(self, data):
+        return self.post('subscriptions/', data)
+
+    def create_subscriptions(self, subscriptions):
+        """
+        Creates the `subscriptions`, POSTing them as a single list if the
+        service accepts lists, or one at a time if it doesn't. Returns the
+        requests.HTTPError each subscription failed with, or None if it was
+        created, in the same order as `subscriptions`.
+        """
+        if len(subscriptions) < 2 or not self.bulk_create:
+            return [self.try_create_subscription(subscription)
+                    for subscription in subscriptions]
+        try:
+            self.post('subscriptions/', subscriptions)
+        except requests.HTTPError as e:
+            try:
+                errors = loads(e.response.content)
+            except ValueError:
+                errors = None
+            if (e.response.status_code == 400 and
+                    isinstance(errors, list) and
+                    len(errors) == len(subscriptions)):
+                # None of the list was created because of the invalid
+                # subscriptions in it, so create the valid ones again
+                valid = [subscription for subscription, error
+                         in zip(subscriptions, errors) if not error]
+                results = iter(self.create_subscriptions(valid))
+                return [
+                    requests.HTTPError(error, response=e.response)
+                    if error else next(results) for error in errors]
+            if e.response.status_code in (400, 405, 415):
+                self.bulk_create = False
+                return self.create_subscriptions(subscriptions)
+            return [e] * len(subscriptions)
+        return [None] * len(subscriptions)
+
+    def try_create_subscription(self, data):
+        try:
+            self.create_subscription(data)
+        except requests.HTTPError as e:
+            return e
+        return None
+
+    def get_subscribed_identities(self, messageset_id, limit=None,
+                                  params=None):
+        """
+        Returns the set of identities subscribed to the messageset, paging
+        through the subscriptions matching `params` once. Returns None if
+        there are more than `limit` of them, in which case checking each
+        identity individually is cheaper. A `limit` of None fetches them
+        regardless.
+        """
+        params = dict(params or {}, messageset=messageset_id)
+        pages = self.get_pages('subscriptions/', params)
+        identities = set()
+        for page in pages:
+            if limit is not None and page.get('count') > limit:
+                return None
+            limit = None
+            identities.update(sub['identity'] for sub in page.get('results'))
+        return identities
+
+
+class IdentityStoreApiClient(SeedServiceApiClient):
+
+    def get_identity(self, identity_id):
+        return self.get('identities/%s' % identity_id)
+
+
+def add_client_arguments(parser):
+    """
+    Adds the arguments for the Stage Based Messaging service, and for how
+    requests are made to the services, that make_client reads, to
+    `parser`. The script must also have a --concurrency argument.
+    """
+    parser.add_argument('--sbm-url', required=True,
+                        help='The url for the Stage Based Messaging service.')
+    parser.add_argument('--sbm-token', required=True,
+                        help='The token for the Stage Based Messaging '
+                        'service.')
+    parser.add_argument('--transport', choices=TRANSPORTS,
+                        default='requests',
+                        help='How to send requests to the services. http2 '
+                        'multiplexes concurrent requests over a few HTTP/2 '
+                        'connections where a service supports it, and needs '
+                        'httpx[http2] to be installed.')
+    parser.add_argument('--max-rate', type=float,
+                        help='The most requests per second to make to each '
+                        'service. The rate and concurrency are lowered when '
+                        'a service is overloaded, and raised again as it '
+                        'recovers.')
+    parser.add_argument('--target-latency', type=float, default=1.0,
+                        help='The 95th percentile response time, in seconds, '
+                        'above which a service is treated as overloaded '
+                        'when using --max-rate.')
+    parser.add_argument(
+        '--metrics', default=False, action='store_const', const=True,
+        help='Print a summary of the requests made to each endpoint, with '
+        'their latencies, to stderr at the end of the run.')
+    parser.add_argument('--metrics-file',
+                        help='Name of file to write the request metrics to '
+                        'at the end of the run.')
+    parser.add_argument('--metrics-format', choices=['json', 'prometheus'],
+                        default='json',
+                        help='The format to write the --metrics-file in.')
+
+
+def make_client(client_class, url, token, args, metrics=None):
+    """
+    Returns a `client_class` client for the service at `url`, making
+    requests as the arguments added by add_client_arguments ask, and
+    recording them in `metrics`. Each client gets its own rate limiter.
+    """
+    return client_class(
+        url, token, pool_size=args.concurrency, metrics=metrics,
+        transport=args.transport, rate_limiter=make_rate_limiter(
+            args.max_rate, args.concurrency, args.target_latency))
+
+
+def make_sbm_client(args):
+    """
+    Returns a StageBasedMessagingApiClient for the service in `args`, whose
+    metrics, if any were asked for, are reported at the end of the run.
+    Clients for other services can share them.
+    """
+    metrics = make_metrics(args.metrics, args.metrics_file,
+                           args.metrics_format)
+    return make_client(StageBasedMessagingApiClient, args.sbm_url,
+                       args.sbm_token, args, metrics)
@@ -1,122 +1,251 @@
-#!/usr/bin/env python
+#!/usr/bin/env python3
 
 import argparse
-import json
 import requests
 import sys
+import threading
 
-session = requests.Session()
-http = requests.adapters.HTTPAdapter(max_retries=5)
-https = requests.adapters.HTTPAdapter(max_retries=5)
-session.mount('http://', http)
-session.mount('https://', https)
+from checkpoint import Checkpoint, add_checkpoint_arguments
+from pipeline import (
+    count_lines, create_batched, map_rows, open_input, parse_shard,
+    read_identities)
+from plan_file import PlanWriter
+from messageset_cache import MessagesetCache, add_messageset_cache_arguments
+from retry_queue import RetryQueue
+from seed_services import add_client_arguments, make_sbm_client
+from subscriptions import SubscriptionCreator, add_creation_arguments
 
-
-def create_sub(url, token, data):
-    headers = {
-        'Authorization': "Token " + token,
-        'Content-Type': "application/json"
-    }
-    if execute:
-        resp = session.post(
-            '%ssubscriptions/' % url, headers=headers, json=data)
-        resp.raise_for_status()
-
-
-def sub_exists(url, token, params):
-    headers = {
-        'Authorization': "Token " + token,
-        'Content-Type': "application/json"
-    }
-    if execute:
-        resp = session.get(
-            '%ssubscriptions/' % url, headers=headers, params=params)
-        resp.raise_for_status()
-        if resp.json().get('count') > 0:
-            return True
-    return False
-
-
-def get_messageset_schedule(url, token, messageset_id):
-    headers = {
-        'Authorization': "Token " + token,
-        'Content-Type': "application/json"
-    }
-    resp = session.get('%smessageset/%s' % (url, messageset_id),
-                       headers=headers)
-    resp.raise_for_status()
-    return resp.json()['default_schedule']
+# The fields every input row must have
+REQUIRED_FIELDS = ('identity', 'language')
 
 
 parser = argparse.ArgumentParser(description='Subscribe users to a specific '
                                  'message set.')
-parser.add_argument('--sbm-url', required=True,
-                    help='The url for the Stage Based Messaging service.')
-parser.add_argument('--sbm-token', required=True,
-                    help='The token for the Stage Based Messaging service.')
+add_client_arguments(parser)
 parser.add_argument('--messageset-id', type=int, required=True,
                     help='The id of the messageset to subscribe users to.')
-parser.add_argument('--file', dest='data_file', type=argparse.FileType('r'),
+parser.add_argument('--file', dest='data_file', type=argparse.FileType('rb'),
                     help='Name of file containing the list of identities.')
 parser.add_argument('--data', help='List of identities. One per line.')
 parser.add_argument(
     '--execute', default=False, action='store_const', const=True,
     help='Execute the changes, rather than just doing a dry run'
 )
+parser.add_argument('--plan',
+                    help='Name of file to write the subscriptions to create '
+                    'to, as JSON lines of their request bodies, rather than '
+                    'creating them. Existing subscriptions are checked as '
+                    'they are with --execute. The plan can then be carried '
+                    'out with execute_plan.py.')
+parser.add_argument(
+    '--prefetch-subscriptions', default=False, action='store_const',
+    const=True,
+    help='Fetch the existing subscriptions for the messageset once, rather '
+    'than checking each identity. Falls back to checking each identity if '
+    'the messageset has more subscriptions than there are identities.'
+)
+parser.add_argument('--concurrency', type=int, default=1,
+                    help='The number of identities to process at a time.')
+add_messageset_cache_arguments(parser)
+parser.add_argument('--shard', type=parse_shard,
+                    help='Only process the identities in shard K/N, the Kth '
+                    'of N shards counting from 0, chosen by a hash of the '
+                    'identity. See run_shards.py. With '
+                    '--prefetch-subscriptions, every shard fetches all the '
+                    'subscriptions to the messageset, so N shards fetch them '
+                    'N times. Each shard falls back to checking each '
+                    'identity if there are more of them than its share of '
+                    'the identities.')
+add_checkpoint_arguments(parser)
+add_creation_arguments(parser)
+
 
 args = parser.parse_args()
 messageset_id = args.messageset_id
-sbm_url = args.sbm_url
-sbm_token = args.sbm_token
 execute = args.execute
 
-if not execute:
+sbm = make_sbm_client(args)
+messageset_cache = MessagesetCache(sbm, args.messageset_cache,
+                                   args.messageset_cache_ttl)
+
+if execute and args.plan:
+    sys.exit("The --plan argument can't be used with --execute.")
+plan_writer = PlanWriter(args.plan) if args.plan else None
+creator = SubscriptionCreator(sbm, execute, plan_writer)
+
+if not execute and plan_writer is None:
     sys.stdout.write(
         "Dry run mode. If you want the actions to be executed, use --execute"
         "\n")
 
-if args.data_file:
-    identity_list = args.data_file.readlines()
-elif args.data:
-    identity_list = args.data.split("\n")
-else:
+if not args.data_file and not args.data:
     sys.exit("Either --file or --data argument must be present.")
+if args.resume and not args.checkpoint:
+    sys.exit("The --resume argument requires --checkpoint.")
+
+input_file = open_input(args.data_file, args.data)
+
+checkpoint = None
+if execute and args.checkpoint:
+    checkpoint = Checkpoint(args.checkpoint, resume=args.resume)
+
+retries = RetryQueue(args.dead_letter, args.retry_attempts)
 
 try:
-    messageset_schedule = get_messageset_schedule(sbm_url, sbm_token,
-                                                  messageset_id)
+    messageset_schedule = messageset_cache.get_schedule(messageset_id)
 except requests.HTTPError as e:
     sys.exit("Problem retrieving the messageset: %s" % e.response.status_code)
 
-count = 0
-for item in identity_list:
-    identity = json.loads(item)
-
+existing_identities = None
+if args.prefetch_subscriptions and (execute or plan_writer is not None):
     try:
-        if sub_exists(args.sbm_url, args.sbm_token,
-                      {'identity': identity['identity'],
-                       'messageset': messageset_id}):
-            sys.stdout.write("Subscription creation skipped - Identity: %s "
-                             "already subscribed to messageset %s\n" %
-                             (identity['identity'], messageset_id))
-            continue
+        existing_identities = sbm.get_subscribed_identities(
+            messageset_id, count_lines(input_file, args.shard))
     except requests.HTTPError as e:
-        sys.stdout.write("Problem retrieving existing subscriptions - "
-                         "Identity: %s Error code: %s\n" %
-                         (identity['identity'], e.response.status_code))
-        continue
+        sys.exit("Problem retrieving existing subscriptions: %s" %
+                 e.response.status_code)
+
+existing_lock = threading.Lock()
+pending_identities = set()
+
+
+def process_identity(identity):
+    """
+    Checks whether a single identity needs to be subscribed to the
+    messageset. Returns the output for the identity, the identity, and the
+    subscription to create for them, if any.
+    """
     data = {
-        'identity': identity['identity'],
-        'lang': identity['language'],
+        'identity': identity.identity,
+        'lang': identity.language,
         'next_sequence_number': 1,
         'messageset': messageset_id,
         'schedule': messageset_schedule
     }
     try:
-        create_sub(args.sbm_url, args.sbm_token, data)
-        count += 1
+        if checkpoint is not None and checkpoint.is_processed(
+                identity.identity, messageset_id):
+            exists = True
+        elif existing_identities is not None:
+            # Claim the identity so that a duplicate row being processed at
+            # the same time doesn't also create a subscription
+            with existing_lock:
+                exists = identity.identity in existing_identities
+                existing_identities.add(identity.identity)
+        else:
+            # Claim the identity until its subscription has been created, so
+            # that a duplicate row in the same batch isn't also subscribed
+            with existing_lock:
+                exists = identity.identity in pending_identities
+                pending_identities.add(identity.identity)
+            if not exists and creator.exists({
+                    'identity': identity.identity,
+                    'messageset': messageset_id}):
+                with existing_lock:
+                    pending_identities.discard(identity.identity)
+                exists = True
+        if exists:
+            if checkpoint is not None:
+                checkpoint.record(identity.identity, messageset_id)
+            return (already_subscribed(identity), identity, None)
     except requests.HTTPError as e:
-        sys.stdout.write("Subscription creation failed - Identity: %s Error "
-                         "code: %s\n" % (identity['identity'],
-                                         e.response.status_code))
-sys.stdout.write("Operation complete. %s Subscriptions created.\n" % count)
+        return (check_failed(identity, data, e), identity, None)
+    return ("", identity, data)
+
+
+def check_failed(identity, data, error):
+    """
+    Handles a failure to check whether the identity is already subscribed,
+    returning the output for the identity. Transient failures are queued
+    like failed creations, since the retry checks again before creating
+    the subscription, and the others are written to the dead letter file.
+    """
+    if retries.add(identity, data, error):
+        if checkpoint is not None:
+            checkpoint.hold(identity.identity, messageset_id)
+        return ""
+    with existing_lock:
+        pending_identities.discard(identity.identity)
+    return ("Problem retrieving existing subscriptions - Identity: %s "
+            "Error code: %s\n" % (identity.identity,
+                                  error.response.status_code))
+
+
+def finish(identity, data, error):
+    """
+    Handles the result of creating the identity's subscription. Returns the
+    output for the identity and whether the subscription was created.
+    Identities that will be retried stay claimed, so that a duplicate row
+    doesn't subscribe them in the meantime, and the checkpoint is held
+    before them until they're done.
+    """
+    if error is None:
+        if checkpoint is not None:
+            checkpoint.record(identity.identity, messageset_id)
+        with existing_lock:
+            pending_identities.discard(identity.identity)
+        return ("", True)
+    if retries.add(identity, data, error):
+        if checkpoint is not None:
+            checkpoint.hold(identity.identity, messageset_id)
+        return ("", False)
+    with existing_lock:
+        pending_identities.discard(identity.identity)
+        if existing_identities is not None:
+            existing_identities.discard(identity.identity)
+    return (failed(identity, error.response.status_code), False)
+
+
+def already_subscribed(identity):
+    return ("Subscription creation skipped - Identity: %s already "
+            "subscribed to messageset %s\n" % (identity.identity,
+                                               messageset_id))
+
+
+def invalid_row(offset, error):
+    sys.stdout.write("Row skipped - Offset: %s Error: %s\n" % (offset, error))
+
+
+def failed(identity, error_code):
+    return ("Subscription creation failed - Identity: %s Error code: %s\n" %
+            (identity.identity, error_code))
+
+
+rows = read_identities(input_file,
+                       checkpoint.offset if checkpoint is not None else 0,
+                       REQUIRED_FIELDS, invalid_row, args.shard)
+results = create_batched(map_rows(process_identity, rows, args.concurrency),
+                         creator.create_many, args.batch_size)
+count = 0
+for offset, (output, identity, data), error in results:
+    if data is not None:
+        output, created = finish(identity, data, error)
+        if created:
+            count += 1
+    sys.stdout.write(output)
+    if checkpoint is not None:
+        checkpoint.advance(offset)
+
+for identity, data, error_code, created in retries.retry(
+        creator.create, creator.created, args.concurrency):
+    if error_code is not None:
+        if checkpoint is not None:
+            checkpoint.release(identity.identity, messageset_id)
+        sys.stdout.write(failed(identity, error_code))
+        continue
+    if checkpoint is not None:
+        checkpoint.record(identity.identity, messageset_id)
+    if created:
+        count += 1
+    else:
+        sys.stdout.write(already_subscribed(identity))
+retries.close()
+if checkpoint is not None:
+    checkpoint.close()
+if plan_writer is not None:
+    plan_writer.close()
+    sys.stdout.write("Operation complete. %s Subscriptions planned.\n" %
+                     plan_writer.count)
+else:
+    sys.stdout.write("Operation complete. %s Subscriptions created.\n" %
+                     count)
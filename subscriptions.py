@@ -0,0 +1,70 @@
+"""
+Creating the subscriptions the scripts decide on, for real, into a plan
+file, or not at all in a dry run, and the arguments the scripts share for
+it.
+"""
+
+
+def add_creation_arguments(parser):
+    """
+    Adds the arguments for how subscriptions are created, and retried, to
+    `parser`.
+    """
+    parser.add_argument('--batch-size', type=int, default=100,
+                        help='The number of subscriptions to create in each '
+                        'request, if the service accepts lists of them.')
+    parser.add_argument('--dead-letter',
+                        help='Name of file to write the rows whose '
+                        'subscriptions couldn\'t be created to, as JSON lines '
+                        'with their error code, so that they can be the '
+                        'input to another run.')
+    parser.add_argument('--retry-attempts', type=int, default=3,
+                        help='The number of times to retry subscription '
+                        'creations that failed with a transient error, once '
+                        'the rest of the run is done.')
+
+
+class SubscriptionCreator(object):
+    """
+    Creates subscriptions with the Stage Based Messaging client `sbm` if
+    `execute` is set, or writes them to the PlanWriter `plan_writer` if
+    one is given. Otherwise it's a dry run, and nothing is created.
+
+    Existing subscriptions are checked with the service unless it's a dry
+    run, so that a plan only has the subscriptions that are missing.
+    """
+
+    def __init__(self, sbm, execute=False, plan_writer=None):
+        self.sbm = sbm
+        self.execute = execute
+        self.plan_writer = plan_writer
+
+    def create(self, data):
+        if self.plan_writer is not None:
+            self.plan_writer.write([data])
+        elif self.execute:
+            self.sbm.create_subscription(data)
+
+    def create_many(self, subscriptions):
+        """
+        Creates a list of subscriptions, returning the HTTPError each one
+        failed with, or None.
+        """
+        if self.plan_writer is not None:
+            self.plan_writer.write(subscriptions)
+        elif self.execute:
+            return self.sbm.create_subscriptions(subscriptions)
+        return [None] * len(subscriptions)
+
+    def exists(self, params):
+        if self.execute or self.plan_writer is not None:
+            return self.sbm.subscription_exists(params)
+        return False
+
+    def created(self, data):
+        """
+        Returns whether the subscription `data` exists, for checking
+        whether a failed request was handled after all.
+        """
+        return self.exists({'identity': data['identity'],
+                            'messageset': data['messageset']})
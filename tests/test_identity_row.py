@@ -0,0 +1,56 @@
+"""
+Checks which input rows are parsed, and which are skipped as invalid.
+"""
+
+import unittest
+
+from identity_row import IdentityRow, InvalidRow
+
+ALL_FIELDS = ('identity', 'language', 'current_messageset_id',
+              'current_sequence_number', 'expected_messageset_id',
+              'expected_sequence_number')
+
+
+class ParseTest(unittest.TestCase):
+
+    def test_all_fields(self):
+        row = IdentityRow.parse(
+            b'{"identity": "a", "language": "eng_ZA", '
+            b'"current_messageset_id": 1, "current_sequence_number": 2, '
+            b'"expected_messageset_id": 3, "expected_sequence_number": 4}',
+            ALL_FIELDS)
+        self.assertEqual(dict(row), {
+            'identity': 'a', 'language': 'eng_ZA',
+            'current_messageset_id': 1, 'current_sequence_number': 2,
+            'expected_messageset_id': 3, 'expected_sequence_number': 4})
+
+    def test_unused_fields_not_checked(self):
+        row = IdentityRow.parse(
+            b'{"identity": "a", "language": "eng_ZA", '
+            b'"current_messageset_id": "1", "current_sequence_number": 2.5, '
+            b'"expected_messageset_id": true, "extra": [1]}')
+        self.assertEqual(dict(row), {'identity': 'a', 'language': 'eng_ZA'})
+
+    def test_missing_field(self):
+        with self.assertRaisesRegex(InvalidRow, 'Missing language'):
+            IdentityRow.parse(b'{"identity": "a"}')
+        with self.assertRaisesRegex(InvalidRow, 'Missing language'):
+            IdentityRow.parse(b'{"identity": "a", "language": null}')
+
+    def test_invalid_field(self):
+        for value in (b'"1"', b'1.0', b'true'):
+            with self.assertRaisesRegex(InvalidRow,
+                                        'Invalid current_messageset_id'):
+                IdentityRow.parse(
+                    b'{"identity": "a", "language": "eng_ZA", '
+                    b'"current_messageset_id": ' + value + b'}',
+                    ('identity', 'language', 'current_messageset_id'))
+
+    def test_invalid_json(self):
+        for line in (b'not json', b'[1, 2]'):
+            with self.assertRaises(InvalidRow):
+                IdentityRow.parse(line)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,72 @@
+"""
+Checks that sharding the identities hands every row to the same shard as
+its identity, whether or not the shard can be found without decoding it.
+"""
+
+import io
+import unittest
+
+from pipeline import line_shard, read_identities, shard_of
+
+ROWS = [
+    b'{"identity": "a", "language": "eng_ZA"}',
+    b'{"language": "eng_ZA", "identity" : "b"}',
+    b'{"identity": "\xc3\xa9", "language": "eng_ZA"}',
+    # Escapes, which line_shard leaves to the full decode
+    b'{"identity": "c\\"d", "language": "eng_ZA"}',
+    b'{"\\u0069dentity": "e", "language": "eng_ZA"}',
+    b'{"identity": "f", "language": "\\u0065ng_ZA"}',
+    # "identity" more than once
+    b'{"meta": {"identity": "g"}, "identity": "h", "language": "eng_ZA"}',
+    b'{"identity": "identity", "language": "eng_ZA"}',
+    # Invalid rows
+    b'{"meta": {"identity": "i"}, "language": "eng_ZA"}',
+    b'{"identity": "j"}',
+    b'{"identity": 1, "language": "eng_ZA"}',
+    b'not json',
+] + [
+    ('{"identity": "id-%s", "language": "eng_ZA"}' % i).encode('utf-8')
+    for i in range(100)
+]
+
+
+def read_shards(count):
+    data = b'\n'.join(ROWS) + b'\n'
+    shards = []
+    for index in range(count):
+        invalid = []
+        rows = read_identities(
+            io.BytesIO(data), invalid=lambda offset, e: invalid.append(offset),
+            shard=(index, count))
+        shards.append(([identity.identity for _, identity in rows], invalid))
+    return shards
+
+
+class ShardTest(unittest.TestCase):
+
+    def test_line_shard(self):
+        self.assertEqual(line_shard(ROWS[0], 7), shard_of('a', 7))
+        self.assertEqual(line_shard(ROWS[1], 7), shard_of('b', 7))
+        self.assertEqual(line_shard(ROWS[2], 7), shard_of(u'\xe9', 7))
+        for row in ROWS[3:8]:
+            self.assertIsNone(line_shard(row, 7))
+
+    def test_every_row_once(self):
+        unsharded, unsharded_invalid = read_shards(1)[0]
+        self.assertEqual(len(unsharded), len(ROWS) - 4)
+        self.assertEqual(len(unsharded_invalid), 4)
+        for count in (2, 3, 7):
+            shards = read_shards(count)
+            for index, (identities, _) in enumerate(shards):
+                for identity in identities:
+                    self.assertEqual(shard_of(identity, count), index)
+            self.assertEqual(
+                sorted(sum((identities for identities, _ in shards), [])),
+                sorted(unsharded))
+            self.assertEqual(
+                sorted(sum((invalid for _, invalid in shards), [])),
+                sorted(unsharded_invalid))
+
+
+if __name__ == '__main__':
+    unittest.main()
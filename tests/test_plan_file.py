@@ -0,0 +1,143 @@
+"""
+Checks that planning a file with duplicate rows plans each subscription
+once, running the scripts against the fake seed services.
+"""
+
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+from urllib.request import urlopen
+
+from plan_file import PlanWriter, read_plan
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+IDENTITIES = 200
+
+
+def free_port():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def rows(expected_messageset):
+    """
+    Rows for IDENTITIES identities that all need subscribing to a
+    messageset by the scripts, given the messageset they're expected to be
+    on, with the first quarter of them repeated.
+    """
+    identities = list(range(IDENTITIES)) + list(range(IDENTITIES // 4))
+    return [{
+        'identity': 'identity-%08d' % i,
+        'language': 'eng_ZA',
+        'current_messageset_id': 3,
+        'current_sequence_number': 1,
+        'expected_messageset_id': expected_messageset,
+        'expected_sequence_number': 30,
+    } for i in identities]
+
+
+class PlanWriterTest(unittest.TestCase):
+
+    def test_duplicates(self):
+        with tempfile.TemporaryDirectory() as work_dir:
+            path = os.path.join(work_dir, 'plan.jsonl')
+            writer = PlanWriter(path)
+            writer.write([{'identity': 'a', 'messageset': 1},
+                          {'identity': 'a', 'messageset': 2}])
+            writer.write([{'identity': 'a', 'messageset': 1},
+                          {'identity': 'b', 'messageset': 1}])
+            writer.close()
+            self.assertEqual(writer.count, 3)
+            with open(path, 'rb') as f:
+                self.assertEqual(
+                    [data for _, data in read_plan(f)],
+                    [{'identity': 'a', 'messageset': 1},
+                     {'identity': 'a', 'messageset': 2},
+                     {'identity': 'b', 'messageset': 1}])
+
+
+class PlanScriptsTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        port = free_port()
+        cls.server = subprocess.Popen([
+            sys.executable,
+            os.path.join(REPO_DIR, 'benchmarks', 'fake_seed_server.py'),
+            '--port', str(port)], stdout=subprocess.DEVNULL)
+        cls.url = 'http://127.0.0.1:%s/' % port
+        for _ in range(100):
+            try:
+                urlopen(cls.url + '_calls').read()
+                break
+            except IOError:
+                time.sleep(0.1)
+        else:
+            cls.server.kill()
+            raise RuntimeError("The fake seed services didn't start")
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.kill()
+        cls.server.wait()
+
+    def plan(self, script, expected_messageset, *script_args):
+        """
+        Plans the rows with the script, returning its output and the plan.
+        """
+        with tempfile.TemporaryDirectory() as work_dir:
+            data_file = os.path.join(work_dir, 'identities.jsonl')
+            with open(data_file, 'w') as f:
+                for row in rows(expected_messageset):
+                    f.write(json.dumps(row) + '\n')
+            plan_file = os.path.join(work_dir, 'plan.jsonl')
+            output = subprocess.check_output([
+                sys.executable, os.path.join(REPO_DIR, script),
+                '--sbm-url', self.url, '--sbm-token', 'token',
+                '--file', data_file, '--plan', plan_file,
+                '--concurrency', '4', '--batch-size', '10',
+            ] + list(script_args), cwd=REPO_DIR)
+            with open(plan_file, 'rb') as f:
+                plan = [data for _, data in read_plan(f)]
+        return output.decode('utf-8'), plan
+
+    def assertPlannedOnce(self, output, plan):
+        planned = [(data['identity'], data['messageset']) for data in plan]
+        self.assertEqual(len(planned), len(set(planned)))
+        self.assertEqual(len(set(data['identity'] for data in plan)),
+                         IDENTITIES)
+        self.assertIn("Operation complete. %s Subscriptions planned.\n" %
+                      len(plan), output)
+
+    def test_service_disruption(self):
+        output, plan = self.plan('service_disruption_subs.py', 8,
+                                 '--messageset-id', '1')
+        self.assertPlannedOnce(output, plan)
+
+    def test_service_disruption_prefetch(self):
+        output, plan = self.plan('service_disruption_subs.py', 8,
+                                 '--messageset-id', '1',
+                                 '--prefetch-subscriptions')
+        self.assertPlannedOnce(output, plan)
+
+    def test_immunisation(self):
+        output, plan = self.plan('immunisation_subs.py', 8,
+                                 '--messageset-ids', '1', '2', '3', '4')
+        self.assertPlannedOnce(output, plan)
+
+    def test_pmtct(self):
+        output, plan = self.plan('pmtct_missed_sets.py', 1)
+        self.assertPlannedOnce(output, plan)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,188 @@
+"""
+Checks the planners built from the rules files against the catch up logic
+the scripts had before it was moved into rules, for every combination of
+current and expected messageset and sequence number that matters.
+"""
+
+import itertools
+import os
+import unittest
+from collections import OrderedDict
+
+from identity_row import IdentityRow
+from planner import (
+    RULES_DIR, InvalidRules, PmtctPlanner, RulesPlanner, load_rules)
+
+IMMUNISATION_MESSAGESETS = [101, 102, 103, 104]
+
+# The messagesets in the rules, their alternates, and some that aren't in
+# any of them
+MESSAGESETS = [1, 2, 3, 4, 5, 7, 8, 11, 42, 43, 46, 47, 48, 49, 50, 99]
+
+# Past the end of the longest messagesets, so every boundary is covered
+SEQUENCE_NUMBERS = range(0, 72)
+
+# The old PMTCT logic loops over every message for each identity, so only
+# the sequence numbers around its important messages, the last of which is
+# 24, and the end of its loop at 69 are checked against it
+PMTCT_SEQUENCE_NUMBERS = list(range(0, 27)) + [68, 69, 70]
+
+
+def immunisation_decision(identity, messagesets):
+    """
+    The immunisation catch up logic as it was written in
+    immunisation_subs.py.
+    """
+    old_set = identity.current_messageset_id
+    new_set = identity.expected_messageset_id
+    old_msg = identity.current_sequence_number
+    new_msg = identity.expected_sequence_number
+
+    # new position in set 8
+    if new_set in (8, 42):
+        if new_msg > 29 and (old_set not in (8, 42) or old_msg <= 29):
+            return messagesets[2]  # send 29
+        elif new_msg > 21 and (old_set not in (8, 42) or old_msg <= 21):
+            return messagesets[1]  # send 21
+        elif new_msg > 13 and (old_set not in (8, 42) or old_msg <= 13):
+            return messagesets[0]  # send 13
+    # new position in set 7
+    elif new_set in (7, 43):
+        if new_msg > 36 and (old_set in (7, 43) or old_msg <= 36):
+            return messagesets[3]  # send 36
+        # they didn't receive the last message of set 8
+        elif old_set not in (7, 43) and old_set != 8:
+            return messagesets[2]  # send 29 of 8
+        elif old_set in (8, 42) and old_msg <= 29:
+            return messagesets[2]  # send 29 of 8
+    return None
+
+
+def pmtct_decision(identity):
+    """
+    The PMTCT catch up logic as it was written in pmtct_missed_sets.py.
+    Returns the messageset and start for the identity's subscription.
+    """
+    set_details = OrderedDict()
+    set_details[3] = {'seq': [8, 15, 24]}
+    set_details[4] = {'seq': [2]}
+    set_details[5] = {'seq': [5]}
+    set_details[1] = {'seq': [6, 15, 17]}
+    set_details[2] = {'seq': []}
+    alternate_messagesets = {46: 3, 47: 4, 48: 5, 49: 1, 50: 2}
+    new_set_ids = {1: 25, 2: 26, 3: 27, 4: 28, 5: 29, 6: 30, 7: 31, 8: 32}
+
+    old_set_id = identity.current_messageset_id
+    old_set_id = alternate_messagesets.get(old_set_id, old_set_id)
+    new_set_id = identity.expected_messageset_id
+    new_set_id = alternate_messagesets.get(new_set_id, new_set_id)
+    old_seq = identity.current_sequence_number
+    new_seq = identity.expected_sequence_number
+
+    if old_set_id in set_details.keys():
+        start = None
+        end = None
+
+        imp_msg_index = 0
+        for key, data in set_details.items():
+            for seq in range(1, 70):
+                if seq in data['seq']:
+                    imp_msg_index += 1
+
+                if (key == old_set_id and seq == old_seq):
+                    start = imp_msg_index + 1
+                    if seq in data['seq']:
+                        start -= 1
+
+                if (key == new_set_id and seq == new_seq):
+                    end = imp_msg_index
+                    if seq in data['seq']:
+                        end -= 1
+
+        if start and end and start <= end:
+            return new_set_ids[end], start
+    return None
+
+
+def all_identities(sequence_numbers=SEQUENCE_NUMBERS):
+    return [
+        IdentityRow('identity', 'eng_ZA', current_set, current_seq,
+                    expected_set, expected_seq)
+        for current_set, current_seq, expected_set, expected_seq
+        in itertools.product(MESSAGESETS, sequence_numbers, MESSAGESETS,
+                             sequence_numbers)]
+
+
+class RulesFileTest(unittest.TestCase):
+
+    def assertPlansEqual(self, identities, planned, expected):
+        """
+        Compares two plans, reporting the first identities they differ for
+        rather than diffing the whole of them.
+        """
+        planned, expected = dict(planned), dict(expected)
+        differences = [
+            (dict(identity), planned.get(i), expected.get(i))
+            for i, identity in enumerate(identities)
+            if planned.get(i) != expected.get(i)]
+        self.assertEqual(differences[:10], [])
+
+    def test_immunisation_rules(self):
+        planner = RulesPlanner(
+            load_rules(os.path.join(RULES_DIR, 'immunisation.json')),
+            IMMUNISATION_MESSAGESETS)
+        identities = all_identities()
+        expected = []
+        for i, identity in enumerate(identities):
+            messageset_id = immunisation_decision(
+                identity, IMMUNISATION_MESSAGESETS)
+            if messageset_id is not None:
+                expected.append((i, messageset_id))
+        self.assertTrue(expected)
+        self.assertPlansEqual(identities, planner.plan(identities), expected)
+
+    def test_pmtct_rules(self):
+        planner = PmtctPlanner.from_rules(
+            load_rules(os.path.join(RULES_DIR, 'pmtct.json')), 69)
+        identities = all_identities(PMTCT_SEQUENCE_NUMBERS)
+        expected = []
+        for i, identity in enumerate(identities):
+            decision = pmtct_decision(identity)
+            if decision is not None:
+                expected.append((i, decision))
+        self.assertTrue(expected)
+        self.assertPlansEqual(identities, planner.plan(identities), expected)
+
+
+class InvalidRulesTest(unittest.TestCase):
+
+    def planner(self, rule):
+        rule = dict({'expected_messageset': 8, 'subscribe_to': 0}, **rule)
+        return RulesPlanner({'rules': [rule]}, IMMUNISATION_MESSAGESETS)
+
+    def test_valid(self):
+        planner = self.planner({'subscribe_to': 3})
+        identity = IdentityRow('identity', 'eng_ZA', 1, 1, 8, 1)
+        self.assertEqual(planner.plan([identity]), [(0, 104)])
+
+    def test_subscribe_to_out_of_range(self):
+        for index in (-1, 4, True, '0', None):
+            with self.assertRaises(InvalidRules):
+                self.planner({'subscribe_to': index})
+
+    def test_missing_field(self):
+        with self.assertRaises(InvalidRules):
+            RulesPlanner({'rules': [{'expected_messageset': 8}]},
+                         IMMUNISATION_MESSAGESETS)
+
+    def test_unknown_condition(self):
+        with self.assertRaises(InvalidRules):
+            self.planner({'current_sequence_below': 3})
+
+    def test_unknown_group(self):
+        with self.assertRaises(InvalidRules):
+            self.planner({'expected_messageset': 'postbirth_3'})
+
+
+if __name__ == '__main__':
+    unittest.main()